@@ -0,0 +1,26 @@
+"""
+Load testing and benchmarks for the trans*ponder web app.
+
+    python3 -m benchmarks generate --rows 10000 --out data.tsv
+    python3 -m benchmarks run --in-memory --rows 10000 --requests 5000
+    python3 -m benchmarks run --url http://localhost:8000 --mongo-url mongodb://... --rows 100000
+    python3 -m benchmarks coldstart --runs 10
+    python3 -m benchmarks limiter --calls 20000
+    python3 -m benchmarks filters --rows 100000
+    python3 -m benchmarks logins --rows 10000 --res-type "Therapist / Counselor"
+
+generate writes a synthetic catalogue shaped like
+RelatedFiles/Sample Data.xlsx, in the format utility/loadDB.py loads.
+run seeds a database with one, replays a mix of the app's traffic
+against it and reports throughput and latency percentiles per
+route. With --in-memory the app runs in this process against
+mongomock (pip install mongomock), so no server or database is
+needed; otherwise it drives a running server over HTTP.
+coldstart times how long a new worker process takes to import the
+app, make it and answer its first request.
+limiter times the rate limiter's token checks, in process and in
+the SQLite store shared by workers. filters times /_disp queries
+in the query engine as more filters are turned on. logins times
+/_disp alone and while other clients hammer /_login, to show that
+password hashing stays off the request threads.
+"""
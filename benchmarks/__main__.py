@@ -0,0 +1,147 @@
+"""
+Command line for the benchmarks; see the package docstring.
+"""
+
+import argparse
+import os
+import sys
+
+from . import coldstart, driver, filters, generate, limiter, login_pressure, report
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(prog="python3 -m benchmarks",
+                                     description="Load tests and benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="Write a synthetic catalogue for loadDB.py")
+    gen.add_argument("--rows", type=int, default=10000, help="Resources to generate")
+    gen.add_argument("--seed", type=int, default=0, help="Random seed")
+    gen.add_argument("--out", default="data.tsv", help="File to write")
+
+    run = commands.add_parser("run", help="Replay traffic and report latencies")
+    target = run.add_mutually_exclusive_group(required=True)
+    target.add_argument("--in-memory", action="store_true",
+                        help="Run the app in process against mongomock")
+    target.add_argument("--url", help="Base url of a running server")
+    run.add_argument("--mongo-url", help="With --url: database to seed first")
+    run.add_argument("--db", default="benchmark", help="With --mongo-url: database name")
+    run.add_argument("--volunteer-pass", default="benchmark-volunteer",
+                     help="With --url: the server's volunteer password")
+    run.add_argument("--rows", type=int, default=10000, help="Resources to seed")
+    run.add_argument("--users", type=int, default=50, help="Users to register")
+    run.add_argument("--requests", type=int, default=5000, help="Requests to make in all")
+    run.add_argument("--concurrency", type=int, default=8, help="Client threads")
+    run.add_argument("--volunteers", type=int, default=1, help="Client threads acting as volunteers")
+    run.add_argument("--seed", type=int, default=0, help="Random seed")
+    run.add_argument("--save", help="Write the summary to this JSON file")
+    run.add_argument("--baseline", help="Fail if p95 latencies regress from this saved summary")
+    run.add_argument("--tolerance", type=float, default=0.2,
+                     help="Allowed p95 regression, as a fraction (default 0.2)")
+
+    cold = commands.add_parser("coldstart", help="Time worker start up, in fresh processes")
+    cold.add_argument("--runs", type=int, default=10, help="Processes to start")
+    cold.add_argument("--save", help="Write the summary to this JSON file")
+
+    limits = commands.add_parser("limiter", help="Time the rate limiter's checks")
+    limits.add_argument("--calls", type=int, default=20000, help="Checks per store and case")
+    limits.add_argument("--clients", type=int, default=1000, help="Client addresses to spread them over")
+    limits.add_argument("--save", help="Write the summary to this JSON file")
+
+    filtering = commands.add_parser("filters", help="Time /_disp filtering in the query engine")
+    filtering.add_argument("--rows", type=int, default=100000, help="Resources to generate")
+    filtering.add_argument("--runs", type=int, default=50, help="Queries per filter count")
+    filtering.add_argument("--save", help="Write the summary to this JSON file")
+
+    logins = commands.add_parser("logins", help="Time /_disp while other clients log in")
+    logins.add_argument("--url", help="Base url of a running server; otherwise run the app in process")
+    logins.add_argument("--rows", type=int, default=10000, help="Without --url: resources to seed")
+    logins.add_argument("--res-type", default="Therapist", help="Category to request from /_disp")
+    logins.add_argument("--requests", type=int, default=200, help="/_disp requests per phase")
+    logins.add_argument("--login-clients", type=int, default=16, help="Concurrent login clients")
+    logins.add_argument("--username", default="benchmark", help="User to log in as")
+    logins.add_argument("--password", default="benchmark", help="Password to log in with")
+    logins.add_argument("--save", help="Write the summary to this JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = command_line_args()
+    for path in (driver.SOURCE, driver.UTILITY):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    if args.command == "generate":
+        generate.write_tsv(args.out, args.rows, args.seed)
+        print("Wrote {} resources to {}".format(args.rows, args.out))
+        return 0
+
+    if args.command == "coldstart":
+        summary = coldstart.summarize(coldstart.measure(args.runs))
+        coldstart.print_summary(summary, args.runs)
+        if args.save:
+            report.save(summary, args.save)
+        return 0
+
+    if args.command == "limiter":
+        summary = limiter.measure(args.calls, args.clients)
+        limiter.print_summary(summary, args.calls)
+        if args.save:
+            report.save(summary, args.save)
+        return 0
+
+    if args.command == "filters":
+        summary = filters.measure(args.rows, args.runs)
+        filters.print_summary(summary, args.rows)
+        if args.save:
+            report.save(summary, args.save)
+        return 0
+
+    if args.command == "logins":
+        summary = login_pressure.measure(args.url, args.rows, args.res_type, args.requests,
+                                         args.login_clients, args.username, args.password)
+        login_pressure.print_summary(summary, args.requests)
+        if args.save:
+            report.save(summary, args.save)
+        return 0
+
+    users = list(generate.generate_users(args.users, args.seed))
+    users[0] = (users[0][0], users[0][1], True)  # At least one volunteer
+    categories = list(generate.CATEGORIES)
+    resources = generate.generate_resources(args.rows, args.seed)
+
+    if args.in_memory:
+        app_module = driver.in_memory_app()
+        print("Seeded {} resources".format(driver.seed(app_module.collection, resources)))
+        volunteer_pass = app_module.password_for_volunteers
+
+        def make_client():
+            return driver.AppClient(app_module.app)
+    else:
+        if args.mongo_url:
+            from pymongo import MongoClient
+            collection = MongoClient(args.mongo_url)[args.db].resources
+            print("Seeded {} resources".format(driver.seed(collection, resources)))
+        volunteer_pass = args.volunteer_pass
+
+        def make_client():
+            return driver.HttpClient(args.url)
+
+    driver.register_users(make_client(), users, volunteer_pass)
+    samples, elapsed = driver.replay(make_client, users, categories, args.requests,
+                                     args.concurrency, args.volunteers)
+    summary = report.summarize(samples, elapsed)
+    report.print_summary(summary, elapsed)
+    if args.save:
+        report.save(summary, args.save)
+    if args.baseline and os.path.exists(args.baseline):
+        found = report.regressions(summary, args.baseline, args.tolerance)
+        for regression in found:
+            print("REGRESSION " + regression)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Measures how long a new server process takes to become ready, as a
+worker does when it boots: importing the app, making it with
+create_app, and answering its first request, each run in a fresh
+interpreter. No database is needed; the first request is for the
+index page, which does not touch it.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from . import report
+from .driver import HERE, SOURCE
+
+# Run in the new interpreter; prints the time each phase took.
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {source!r})
+import config, flask_main
+imported = time.perf_counter()
+app = flask_main.create_app(config.configuration(proxied=True, config_file={config_path!r}))
+created = time.perf_counter()
+status = app.test_client().get("/").status_code
+served = time.perf_counter()
+print(json.dumps({{"import": imported - start, "create_app": created - imported,
+                  "first_request": served - created, "status": status}}))
+"""
+
+PHASES = ["interpreter", "import", "create_app", "first_request", "total"]
+
+
+def measure(runs=10, config_path=os.path.join(HERE, "bench.ini")):
+    """
+    Starts runs fresh processes. Returns a list of dicts holding the
+    seconds each phase took in each; "interpreter" is the time to
+    start Python itself, and "total" the whole process.
+    """
+    script = SCRIPT.format(source=SOURCE, config_path=config_path)
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        finished = subprocess.run([sys.executable, "-c", script], cwd=SOURCE,
+                                  capture_output=True, text=True, check=True)
+        total = time.perf_counter() - start
+        phases = json.loads(finished.stdout.strip().splitlines()[-1])
+        if phases.pop("status") != 200:
+            raise RuntimeError("The index page failed: " + finished.stderr[-500:])
+        phases["total"] = total
+        phases["interpreter"] = total - sum(phases[phase] for phase in
+                                            ("import", "create_app", "first_request"))
+        samples.append(phases)
+    return samples
+
+
+def summarize(samples):
+    """
+    Returns the median and slowest milliseconds of each phase.
+    """
+    summary = {}
+    for phase in PHASES:
+        times = sorted(sample[phase] * 1000 for sample in samples)
+        summary[phase] = {"p50_ms": report.percentile(times, 0.5), "max_ms": times[-1]}
+    return summary
+
+
+def print_summary(summary, runs):
+    print("{:<16} {:>9} {:>9}".format("phase", "p50 ms", "max ms"))
+    for phase, figures in summary.items():
+        print("{:<16} {p50_ms:>9.1f} {max_ms:>9.1f}".format(phase, **figures))
+    print("{} cold starts".format(runs))
@@ -0,0 +1,211 @@
+"""
+Replays a mix of the app's traffic against it from several client
+threads, and records the route, status, latency and size of every
+request. The app is reached either over HTTP or, for offline runs,
+through the flask test client of an in-process app on mongomock.
+"""
+
+import http.cookiejar
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(os.path.dirname(HERE), "source")
+UTILITY = os.path.join(SOURCE, "utility")  # loadDB.py, for generate.generate_resources
+
+# Requests made by public visitors, and how often, relative to each other.
+PUBLIC_MIX = {"disp": 60, "categories": 15, "create": 5, "login": 20}
+# Volunteers also work through the moderation queue.
+VOLUNTEER_MIX = {"disp": 30, "categories": 5, "login": 5, "unverified": 40, "moderate": 20}
+
+CATEGORY_ROUTES = ["/_verifiedcategories", "/_allcategories", "/_unverifiedcategories"]
+
+
+class HttpClient:
+    """
+    One visitor's session with a running server.
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def get(self, path, params=None):
+        url = self.base_url + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        try:
+            with self.opener.open(url) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as err:
+            return err.code, err.read()
+
+
+class AppClient:
+    """
+    One visitor's session with an in-process app.
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path, params=None):
+        response = self.client.get(path, query_string=params or {})
+        return response.status_code, response.get_data()
+
+
+def in_memory_app(config_path=os.path.join(HERE, "bench.ini")):
+    """
+    Makes the app with mongomock standing in for the database.
+    Returns the flask_main module.
+    """
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    if SOURCE not in sys.path:
+        sys.path.insert(0, SOURCE)
+    import config
+    import flask_main
+    flask_main.create_app(config.configuration(proxied=True, config_file=config_path))
+    return flask_main
+
+
+def seed(collection, resources, batch_size=1000):
+    """
+    Inserts generated resources into a collection in batches.
+    Returns the number inserted.
+    """
+    batch = []
+    count = 0
+    for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+class Visitor:
+    """
+    A client thread: makes requests from its mix and records them.
+    """
+    def __init__(self, client, number, users, categories, volunteer, samples, lock):
+        self.client = client
+        self.number = number
+        self.users = users
+        self.categories = categories
+        self.volunteer = volunteer
+        self.samples = samples
+        self.lock = lock
+        self.rng = random.Random(number)
+        self.mix = VOLUNTEER_MIX if volunteer else PUBLIC_MIX
+        self.queue_ids = []
+        self.created = 0
+
+    def request(self, route, path, params=None):
+        start = time.perf_counter()
+        status, body = self.client.get(path, params)
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.samples.append((route, status, seconds, len(body)))
+        return status, body
+
+    def disp(self):
+        params = {"res_type": self.rng.choice(self.categories)}
+        for arg in ("filter_ohp", "filter_monitor_hormones", "filter_pvt_ins"):
+            if self.rng.random() < 0.2:
+                params[arg] = "True"
+        if self.rng.random() < 0.5:
+            params["limit"] = 50
+        self.request("/_disp", "/_disp", params)
+
+    def categories_list(self):
+        path = self.rng.choice(CATEGORY_ROUTES)
+        self.request(path, path)
+
+    def create(self):
+        self.created += 1
+        self.request("/_create", "/_create", {
+            "type": self.rng.choice(self.categories),
+            "name": "Benchmark {} {}".format(self.number, self.created),
+            "address": "1 Benchmark St, Eugene, OR 97401",
+            "takes_OHP": self.rng.choice(["yes", "no", "N/A"]),
+        })
+
+    def login(self):
+        username, password, _ = self.rng.choice(self.users)
+        if self.rng.random() < 0.1:
+            password += "wrong"
+        self.request("/_login", "/_login", {"username": username, "password": password})
+
+    def unverified(self):
+        status, body = self.request("/_unverified", "/_unverified", {"limit": 20})
+        try:
+            resources = json.loads(body)["result"]["resources"]
+            self.queue_ids = [record["id"] for record in resources if "id" in record]
+        except (ValueError, KeyError, TypeError):
+            self.queue_ids = []
+
+    def moderate(self):
+        if not self.queue_ids:
+            return self.unverified()
+        ids = self.queue_ids[:self.rng.randint(1, 5)]
+        self.queue_ids = self.queue_ids[len(ids):]
+        path = "/_verify_batch" if self.rng.random() < 0.7 else "/_del_batch"
+        self.request(path, path, {"ids": ",".join(ids)})
+
+    def run(self, requests):
+        actions = {"disp": self.disp, "categories": self.categories_list, "create": self.create,
+                   "login": self.login, "unverified": self.unverified, "moderate": self.moderate}
+        names = list(self.mix)
+        weights = list(self.mix.values())
+        for _ in range(requests):
+            actions[self.rng.choices(names, weights=weights)[0]]()
+
+
+def register_users(client, users, volunteer_pass):
+    """
+    Registers the generated users through the app.
+    """
+    for username, password, volunteer in users:
+        params = {"username": username, "password": password}
+        if volunteer:
+            params["volunteer_pass"] = volunteer_pass
+        client.get("/_register", params)
+
+
+def replay(make_client, users, categories, requests, concurrency, volunteers=1):
+    """
+    Runs concurrency visitors, the first volunteers of them logged in
+    as volunteers, making requests between them. Returns the samples
+    and the elapsed time.
+    """
+    samples = []
+    lock = threading.Lock()
+    volunteer_users = [user for user in users if user[2]] or users
+    visitors = []
+    for number in range(concurrency):
+        client = make_client()
+        volunteer = number < volunteers
+        if volunteer:
+            username, password, _ = volunteer_users[number % len(volunteer_users)]
+            client.get("/_login", {"username": username, "password": password})
+        visitors.append(Visitor(client, number, users, categories, volunteer, samples, lock))
+    per_visitor = max(1, requests // concurrency)
+    threads = [threading.Thread(target=visitor.run, args=(per_visitor,)) for visitor in visitors]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start
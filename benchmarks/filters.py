@@ -0,0 +1,64 @@
+"""
+Measures /_disp filtering on its own, without the app or a database:
+how long the query engine takes to answer a category with 0, 1, 2,
+... of the /_disp filters on, next to filtering the same resources
+record by record. The engine's times should stay about the same as
+filters are added.
+"""
+
+import time
+
+from . import generate, report
+
+
+def time_queries(select, resource_type, fields, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        select(resource_type, fields)
+        samples.append((time.perf_counter() - start) * 1000)
+    return sorted(samples)
+
+
+def measure(rows=100000, runs=50, seed=0):
+    """
+    Returns {filters on: {"engine"/"scan": p50 and p99 ms, "matches"}},
+    querying the largest category.
+    """
+    import catalogue  # From source/, put on the path by the caller
+    import query_engine  # In-process /_disp over bitmap columns
+    documents = [document for document in generate.generate_resources(rows, seed)
+                 if document["verified"]]
+    documents.sort(key=lambda document: (document["type"], document["name"]))
+    engine = query_engine.QueryEngine()
+    engine.load(documents)
+    by_type = {}
+    for document in documents:
+        by_type[document["type"]] = by_type.get(document["type"], 0) + 1
+    resource_type = max(by_type, key=by_type.get)
+
+    def scan(resource_type, fields):
+        return [document for document in documents if document["type"] == resource_type
+                and all(document.get(field) is True for field in fields)]
+
+    fields = list(catalogue.DISP_FILTERS.values())
+    summary = {}
+    for count in range(len(fields) + 1):
+        on = fields[:count]
+        figures = {"matches": len(engine.fragments(resource_type, on))}
+        for name, select in (("engine", engine.fragments), ("scan", scan)):
+            samples = time_queries(select, resource_type, on, runs)
+            figures[name] = {"p50_ms": report.percentile(samples, 0.5),
+                             "p99_ms": report.percentile(samples, 0.99)}
+        summary[count] = figures
+    return summary
+
+
+def print_summary(summary, rows):
+    print("{:>7} {:>8} {:>14} {:>14} {:>12} {:>12}".format(
+        "filters", "matches", "engine p50 ms", "engine p99 ms", "scan p50 ms", "scan p99 ms"))
+    for count, figures in summary.items():
+        print("{:>7} {:>8} {:>14.3f} {:>14.3f} {:>12.3f} {:>12.3f}".format(
+            count, figures["matches"], figures["engine"]["p50_ms"], figures["engine"]["p99_ms"],
+            figures["scan"]["p50_ms"], figures["scan"]["p99_ms"]))
+    print("{} resources generated, the largest category queried".format(rows))
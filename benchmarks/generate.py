@@ -0,0 +1,101 @@
+"""
+Synthetic catalogue and user datasets, shaped like the sample data:
+the same categories in roughly the same proportions, and the same
+mix of "Yes", "No" and unanswered ("-") answers.
+"""
+
+import random
+
+# Categories in the sample data, weighted by how often they appear.
+CATEGORIES = {
+    "Psychologist": 8, "Social Support": 7, "Therapist / Counselor": 7, "Surgeon": 5,
+    "Surgery Scholarship": 4, "Youth Support": 4, "Primary Care": 2, "Chiropractor": 1,
+    "Endocrinologist": 1, "Gynecologist": 1, "Laser / Electrolysis": 1,
+}
+# How the yes/no questions were answered in the sample data.
+ANSWERS = {"-": 65, "Yes": 22, "No": 9, "yes": 2, "no": 2}
+HORMONE_ANSWERS = {"-": 90, "HRT": 10}
+
+FIRST_NAMES = ["Alex", "Andrea", "Casey", "Dana", "Douglas", "Elliot", "Geoffrey", "Jamie",
+               "Jordan", "Kai", "Morgan", "Nara", "Quinn", "Riley", "Rob", "Rowan", "Sam",
+               "Sasha", "Taylor", "Toni"]
+LAST_NAMES = ["Austin", "Baker", "Champer", "Chen", "Emery", "Garcia", "Gill", "Hughes",
+              "Kim", "Lopez", "Morales", "Nguyen", "Nosler", "Okafor", "Patel", "Reyes",
+              "Schmidt", "Smith", "Voorhees", "Walker"]
+OFFICE_WORDS = ["Complete", "Wellness", "Family", "Health", "Care", "Center", "Clinic",
+                "Counseling", "Community", "Womens", "Valley", "Riverside", "Cascade"]
+STREETS = ["Willamette St", "Country Club Pkwy", "E 12th Ave", "Pearl St", "Oak St",
+           "High St", "Olive St", "Main St", "Coburg Rd", "River Rd"]
+# City, zip, and a point near its centre.
+CITIES = [("Eugene", "97401", 44.05, -123.09), ("Springfield", "97477", 44.05, -122.98),
+          ("Portland", "97205", 45.52, -122.68), ("Salem", "97301", 44.94, -123.03),
+          ("Corvallis", "97330", 44.56, -123.26), ("Bend", "97701", 44.06, -121.31)]
+
+
+def weighted(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def generate_rows(count, seed=0):
+    """
+    Yields count resources as lists of cells, in the column order
+    of catalogue.COLUMNS followed by a latitude and longitude.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        city, zip_code, latitude, longitude = rng.choice(CITIES)
+        office = " ".join(rng.sample(OFFICE_WORDS, 2))
+        domain = office.lower().replace(" ", "") + ".com"
+        yield [
+            weighted(rng, CATEGORIES),
+            "{} {} {}".format(first, last, i),  # Unique, as (type, name) must be
+            office,
+            "{} {}, {}, OR {}".format(rng.randint(1, 3999), rng.choice(STREETS), city, zip_code),
+            "541-{:03d}-{:04d}".format(rng.randint(200, 999), rng.randint(0, 9999)),
+            "{}.{}@{}".format(first.lower(), last.lower(), domain),
+            "http://www.{}/".format(domain),
+        ] + [weighted(rng, ANSWERS) for _ in range(6)] + [
+            weighted(rng, HORMONE_ANSWERS),
+            rng.choice(["", "", "Call ahead", "Sliding scale based on annual household income"]),
+            "{:.5f}".format(latitude + rng.uniform(-0.08, 0.08)),
+            "{:.5f}".format(longitude + rng.uniform(-0.08, 0.08)),
+        ]
+
+
+def generate_resources(count, seed=0, verified_fraction=0.9):
+    """
+    Yields count resource documents, as the loader would store them.
+    """
+    import loadDB  # From source/utility/, put on the path by the caller
+    rng = random.Random(seed + 1)
+    for cells in generate_rows(count, seed):
+        yield loadDB.to_resource(cells, verified=rng.random() < verified_fraction)
+
+
+def generate_users(count, seed=0, volunteer_fraction=0.05):
+    """
+    Yields count (username, password, is_volunteer) tuples.
+    """
+    rng = random.Random(seed + 2)
+    for i in range(count):
+        username = "{}{}{}".format(rng.choice(FIRST_NAMES).lower(), rng.choice(LAST_NAMES).lower(), i)
+        password = "".join(rng.choice("abcdefghijkmnpqrstuvwxyz23456789") for _ in range(12))
+        yield username, password, rng.random() < volunteer_fraction
+
+
+def header_row():
+    import catalogue
+    return catalogue.COLUMNS + catalogue.OPTIONAL_COLUMNS
+
+
+def write_tsv(path, count, seed=0):
+    """
+    Writes count resources to a tab separated file loadDB.py can load.
+    """
+    import csv
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        writer = csv.writer(out, delimiter="\t")
+        writer.writerow(header_row())
+        for row in generate_rows(count, seed):
+            writer.writerow(row)
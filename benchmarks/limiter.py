@@ -0,0 +1,57 @@
+"""
+Measures what the rate limiter costs each request: the time to take
+a token, and to refuse one, from each kind of bucket store. This
+needs neither the app nor a database.
+"""
+
+import os
+import tempfile
+import time
+
+from . import report
+
+
+def time_checks(limiter, name, calls, clients):
+    """
+    Returns the microseconds each of calls limiter.check()s took,
+    spread over clients addresses.
+    """
+    samples = []
+    for call in range(calls):
+        client = "10.0.{}.{}".format(call % clients // 256, call % clients % 256)
+        start = time.perf_counter()
+        limiter.check(name, client)
+        samples.append((time.perf_counter() - start) * 1e6)
+    return sorted(samples)
+
+
+def measure(calls=20000, clients=1000):
+    """
+    Returns {store: {case: figures}}: the p50, p99 and mean
+    microseconds of allowed and refused checks.
+    """
+    import ratelimit  # Token bucket limits on the costly public endpoints
+    # Allowed: buckets too big to empty; refused: buckets already empty.
+    cases = {"allowed": ratelimit.Limit(1e6, 1e9), "refused": ratelimit.Limit(1e-9, 0)}
+    summary = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {"memory": ratelimit.MemoryStore,
+                  "sqlite": lambda: ratelimit.SqliteStore(os.path.join(tmp, "buckets.sqlite"))}
+        for store_name, make_store in stores.items():
+            summary[store_name] = {}
+            for case, limit in cases.items():
+                limiter = ratelimit.RateLimiter({case: (limit, limit)}, store=make_store())
+                samples = time_checks(limiter, case, calls, clients)
+                summary[store_name][case] = {"p50_us": report.percentile(samples, 0.5),
+                                             "p99_us": report.percentile(samples, 0.99),
+                                             "mean_us": sum(samples) / len(samples)}
+    return summary
+
+
+def print_summary(summary, calls):
+    print("{:<8} {:<8} {:>9} {:>9} {:>9}".format("store", "check", "p50 us", "p99 us", "mean us"))
+    for store, cases in summary.items():
+        for case, figures in cases.items():
+            print("{:<8} {:<8} {p50_us:>9.1f} {p99_us:>9.1f} {mean_us:>9.1f}".format(
+                store, case, **figures))
+    print("{} checks per store and case".format(calls))
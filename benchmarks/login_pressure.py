@@ -0,0 +1,99 @@
+"""
+Measures /_disp latency on its own, and again while other clients
+hammer /_login, against a running server. With password hashing
+off the request thread, the two sets of figures should be close.
+All the logins come from one address, so the server must run with
+rate_limit_login and rate_limit_register blank, as in bench.ini;
+otherwise most of them get a 429 and hash nothing. With no url,
+the app is served from this process on mongomock, configured from
+bench.ini, over a threaded local server.
+"""
+
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import driver, generate, report
+
+
+def serve_in_memory(rows):
+    """
+    Serves the app on mongomock, seeded with rows generated
+    resources, from a thread. Returns its url.
+    """
+    from werkzeug.serving import make_server
+    app_module = driver.in_memory_app()
+    driver.seed(app_module.collection, generate.generate_resources(rows))
+    server = make_server("localhost", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://localhost:{}".format(server.port)
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as err:
+        return err.code
+
+
+def time_disp(url, res_type, requests):
+    url = "{}/_disp?{}".format(url, urllib.parse.urlencode({"res_type": res_type}))
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        get(url)
+        samples.append((time.perf_counter() - start) * 1000)
+    return sorted(samples)
+
+
+def hammer_logins(url, stop, counts):
+    while not stop.is_set():
+        status = get(url)
+        counts[status] = counts.get(status, 0) + 1
+
+
+def figures(samples):
+    return {"p50_ms": report.percentile(samples, 0.50),
+            "p95_ms": report.percentile(samples, 0.95),
+            "p99_ms": report.percentile(samples, 0.99)}
+
+
+def measure(url=None, rows=10000, res_type="Therapist", requests=200, login_clients=16,
+            username="benchmark", password="benchmark"):
+    """
+    Returns the /_disp figures alone and during the login burst,
+    and the login responses by status. Serves the app in process
+    when url is None.
+    """
+    if url is None:
+        url = serve_in_memory(rows)
+    credentials = urllib.parse.urlencode({"username": username, "password": password})
+    get("{}/_register?{}".format(url, credentials))  # Make sure the login user exists
+
+    summary = {"alone": figures(time_disp(url, res_type, requests))}
+    stop = threading.Event()
+    counts = {}
+    clients = [threading.Thread(target=hammer_logins, daemon=True,
+                                args=("{}/_login?{}".format(url, credentials), stop, counts))
+               for _ in range(login_clients)]
+    for client in clients:
+        client.start()
+    time.sleep(1)  # Let the burst build up
+    summary["during_logins"] = figures(time_disp(url, res_type, requests))
+    stop.set()
+    for client in clients:
+        client.join()
+    summary["login_statuses"] = {str(status): count for status, count in sorted(counts.items())}
+    return summary
+
+
+def print_summary(summary, requests):
+    for phase, label in (("alone", "/_disp alone"), ("during_logins", "/_disp during logins")):
+        print("{:<22} p50 {p50_ms:7.2f} ms   p95 {p95_ms:7.2f} ms   p99 {p99_ms:7.2f} ms".format(
+            label, **summary[phase]))
+    print("{} /_disp requests per phase; login responses by status: {}".format(
+        requests, summary["login_statuses"]))
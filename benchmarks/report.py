@@ -0,0 +1,81 @@
+"""
+Throughput and latency percentiles per route, and comparison of a
+run against a saved baseline to catch regressions.
+"""
+
+import json
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, elapsed):
+    """
+    Summarizes (route, status, seconds, size) samples from a run
+    lasting elapsed seconds into a dict of figures per route. Every
+    response that is not a success or a redirect is an error; the
+    errors are counted by status too, so refusals (429, 503) show.
+    """
+    by_route = {}
+    for route, status, seconds, size in samples:
+        by_route.setdefault(route, []).append((status, seconds, size))
+    summary = {}
+    for route, results in sorted(by_route.items()):
+        latencies = sorted(seconds * 1000 for _, seconds, _ in results)
+        statuses = {}
+        for status, _, _ in results:
+            if not 200 <= status < 400:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[route] = {
+            "requests": len(results),
+            "errors": sum(statuses.values()),
+            "error_statuses": statuses,
+            "throughput": len(results) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "mean_bytes": sum(size for _, _, size in results) / len(results),
+        }
+    return summary
+
+
+def print_summary(summary, elapsed):
+    print("{:<24} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "bytes"))
+    for route, figures in summary.items():
+        print("{:<24} {requests:>8} {errors:>6} {throughput:>9.1f} {p50_ms:>9.2f} "
+              "{p95_ms:>9.2f} {p99_ms:>9.2f} {mean_bytes:>10.0f}".format(route, **figures))
+    for route, figures in summary.items():
+        if figures.get("error_statuses"):
+            print("{} errors by status: {}".format(route, ", ".join(
+                "{} x{}".format(status, count)
+                for status, count in sorted(figures["error_statuses"].items()))))
+    total = sum(figures["requests"] for figures in summary.values())
+    print("{} requests in {:.2f} s: {:.1f} req/s".format(total, elapsed, total / elapsed if elapsed else 0))
+
+
+def save(summary, path):
+    with open(path, "w") as out:
+        json.dump(summary, out, indent=2, sort_keys=True)
+
+
+def regressions(summary, baseline_path, tolerance=0.2):
+    """
+    Returns a description of each route whose p95 latency is more
+    than tolerance (a fraction) worse than in the saved baseline.
+    """
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    found = []
+    for route, figures in summary.items():
+        before = baseline.get(route)
+        if not before or not before["p95_ms"]:
+            continue
+        change = figures["p95_ms"] / before["p95_ms"] - 1
+        if change > tolerance:
+            found.append("{}: p95 {:.2f} ms -> {:.2f} ms (+{:.0%})".format(
+                route, before["p95_ms"], figures["p95_ms"], change))
+    return found
@@ -0,0 +1,125 @@
+"""
+Bloom filters, for answering "certainly not there" without a
+database round trip.
+UsernameFilter holds the registered usernames. /_checkname asks it
+first, on every keystroke of the registration form, and only goes
+to mongo when the name might be taken. Other workers register
+users too, so each process rebuilds its filter periodically; in
+between, a name registered elsewhere may be reported free, but the
+unique index on username still refuses it at registration.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity=100000, error_rate=0.01):
+        # Sized for error_rate false positives once capacity items are in.
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64 bit hashes.
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class UsernameFilter:
+    def __init__(self, capacity=100000, error_rate=0.01, refresh=60):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh = refresh  # Seconds between rebuilds
+        self._filter = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._added = []  # Usernames added while a rebuild runs
+        self.skipped = 0  # Lookups answered without the database
+        self.lookups = 0
+
+    def _build(self, usernames):
+        fresh = BloomFilter(max(self.capacity, 1), self.error_rate)
+        for username in usernames:
+            fresh.add(username)
+        return fresh
+
+    def load(self, load_usernames):
+        """
+        Replaces the filter with one of load_usernames(), keeping any
+        usernames added while it was being built.
+        """
+        with self._lock:
+            self._added = []
+        fresh = self._build(load_usernames())
+        with self._lock:
+            for username in self._added:
+                fresh.add(username)
+            self._added = []
+            self._filter = fresh
+            self._loaded_at = time.monotonic()
+        log.debug("Username filter loaded with {} names".format(fresh.count))
+
+    def ensure_loaded(self, load_usernames):
+        """
+        Loads the filter on first use, and rebuilds it in a background
+        thread once it is older than the refresh interval.
+        """
+        if self._filter is None:
+            self.load(load_usernames)
+            return
+        if time.monotonic() - self._loaded_at < self.refresh or self._rebuilding:
+            return
+        self._rebuilding = True
+
+        def rebuild():
+            try:
+                self.load(load_usernames)
+            except Exception as err:
+                log.warning("Username filter rebuild failed: {}".format(err))
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def add(self, username):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(username)
+            if self._rebuilding or self._filter is None:
+                self._added.append(username)
+
+    def might_exist(self, username):
+        """
+        False only if username is certainly not registered (as of the
+        last rebuild, and in this process since).
+        """
+        with self._lock:
+            self.lookups += 1
+            if self._filter is None or username in self._filter:
+                return True
+            self.skipped += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {"names": self._filter.count if self._filter else 0,
+                    "lookups": self.lookups, "skipped": self.skipped}
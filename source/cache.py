@@ -0,0 +1,81 @@
+"""
+A small in-process read-through cache for catalogue reads.
+Entries are evicted least recently used first once the cache
+is full, and expire after a fixed time to live so that writes
+made by other server processes are eventually picked up.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class CatalogueCache:
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry time, value)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a value built from data read
+        # before a write is not stored after the write invalidated it.
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, build):
+        """
+        Returns the cached value for key, calling build() to
+        produce (and cache) it on a miss or after it expires.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+        # Built outside the lock, so a slow database query does
+        # not hold up readers of other keys.
+        value = build()
+        with self._lock:
+            if generation != self._generation:
+                return value
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, matches):
+        """
+        Drops every entry whose key satisfies matches(key).
+        """
+        with self._lock:
+            self._generation += 1
+            stale = [key for key in self._entries if matches(key)]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,354 @@
+"""
+Queries and indexes over the resources collection.
+Shared by the flask app and the utility scripts, so that the
+filtering and sorting for /_disp is done by mongo (against an
+index) rather than in python.
+"""
+
+import base64
+import json
+import re
+import unicodedata
+
+import bson  # ObjectIds, installed with pymongo
+import pymongo  # Mongo database
+
+# The /_disp filter arguments, and the resource field each one requires.
+DISP_FILTERS = {
+    "filter_ohp": "takes_OHP",
+    "filter_monitor_hormones": "can_monitor_hormones",
+    "filter_pvt_ins": "takes_private_ins",
+    "filter_sliding_scale": "sliding_scale",
+    "filter_diversity_aware": "diversity_aware",
+    "filter_paperwork_not_only_mf": "paperwork_not_only_mf",
+    "filter_paperwork_asks_for_pronoun": "paperwork_asks_for_pronoun",
+}
+# The filters with an index of their own (see INDEXES). Each index
+# slows every write, and public /_disp lists are mostly answered by
+# the query engine, so the later filters share type_verified_name_id.
+INDEXED_FILTERS = ("filter_ohp", "filter_monitor_hormones", "filter_pvt_ins")
+
+# The fields of a resource, in the order of the submission form
+# and of the columns in the spreadsheets the loader reads.
+TEXT_FIELDS = ["type", "name", "office_name", "address", "phone", "email", "website"]
+BOOLEAN_FIELDS = ["takes_OHP", "takes_private_ins", "sliding_scale", "diversity_aware",
+                  "paperwork_not_only_mf", "paperwork_asks_for_pronoun",
+                  "can_monitor_hormones"]
+COLUMNS = TEXT_FIELDS + BOOLEAN_FIELDS + ["notes"]
+# Coordinates may follow the notes, where they are known.
+OPTIONAL_COLUMNS = ["latitude", "longitude"]
+
+# Fields kept in the database but never sent to the front end: the
+# mongo id, the version bumped by every write to a resource, the
+# catalogue revision of its last write (see changes.py), the keys
+# for finding duplicates (see name_key and dedupe.py), and the
+# tokens of a batch moderation under way (see flask_main.moderate).
+HIDDEN_FIELDS = ("_id", "version", "rev", "name_key", "dup_keys", "duplicates",
+                 "moderated_by", "deleting")
+PUBLIC_PROJECTION = {field: False for field in HIDDEN_FIELDS}
+# Also sent to volunteers, with the ids (see public_record).
+MODERATION_FIELDS = ("duplicates",)
+
+# Resources are always listed in name order. The id breaks ties
+# between equal names, so pages of results can be keyed on it.
+NAME_ORDER = [("name", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+
+# Indexes the app relies on. Every /_disp query is an equality match
+# on type and verified (plus optionally one or more filter flags),
+# sorted by name and id, so each index ends in name and id to keep
+# the scan in sorted order without a blocking sort stage. Only the
+# INDEXED_FILTERS have a filter flag index.
+INDEXES = [
+    pymongo.IndexModel([("type", pymongo.ASCENDING),
+                        ("verified", pymongo.ASCENDING)] + NAME_ORDER,
+                       name="type_verified_name_id"),
+    pymongo.IndexModel([("verified", pymongo.ASCENDING)] + NAME_ORDER,
+                       name="verified_name_id"),
+] + [
+    pymongo.IndexModel([("type", pymongo.ASCENDING),
+                        ("verified", pymongo.ASCENDING),
+                        (field, pymongo.ASCENDING)] + NAME_ORDER,
+                       name="type_verified_{}_name_id".format(field))
+    for field in (DISP_FILTERS[arg] for arg in INDEXED_FILTERS)
+] + [
+    # For /_nearby. Resources without a location are left out of it.
+    pymongo.IndexModel([("location", pymongo.GEOSPHERE),
+                        ("type", pymongo.ASCENDING),
+                        ("verified", pymongo.ASCENDING)],
+                       name="location_type_verified"),
+    # One resource per type and (normalized) name. Resources stored
+    # before name_key existed have none until utility/findDuplicates.py runs.
+    pymongo.IndexModel([("name_key", pymongo.ASCENDING)], name="name_key_unique",
+                       unique=True, partialFilterExpression={"name_key": {"$type": "string"}}),
+    # Blocking keys of the near-duplicate search.
+    pymongo.IndexModel([("dup_keys", pymongo.ASCENDING)], name="dup_keys"),
+    # For /_changes: the resources written after a revision.
+    pymongo.IndexModel([("rev", pymongo.ASCENDING)], name="rev"),
+    # For /_export of one type: its verified resources in id order.
+    pymongo.IndexModel([("type", pymongo.ASCENDING),
+                        ("verified", pymongo.ASCENDING),
+                        ("_id", pymongo.ASCENDING)],
+                       name="type_verified_id"),
+]
+
+
+def ensure_indexes(collection):
+    """
+    Creates the indexes in INDEXES on the resources collection.
+    Safe to call on every startup; mongo skips existing indexes.
+    """
+    return collection.create_indexes(INDEXES)
+
+
+def interp_bool(boolesque_string):
+    """
+    Interprets a yes/no answer from the submission form. "N/A" is
+    kept as is; anything else that is not "yes" is a no.
+    """
+    if boolesque_string == "yes":
+        return True
+    if boolesque_string == "N/A":
+        return boolesque_string
+    return False
+
+
+def normalize(text):
+    """
+    Folds text for comparison: lower case, without accents or
+    punctuation, and with single spaces.
+    """
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[\W_]+", " ", text.casefold()).split())
+
+
+def name_key(resource_type, name):
+    """
+    The key no two resources may share: type and name, normalized.
+    """
+    return "{}|{}".format(normalize(resource_type), normalize(name))
+
+
+def location_from(latitude, longitude):
+    """
+    Returns a GeoJSON point for a latitude and longitude given as
+    numbers or text, or None if either is missing or out of range.
+    """
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    # GeoJSON puts the longitude first.
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+def new_resource(fields, verified=False):
+    """
+    Builds a resource document from a mapping of field name to
+    the text submitted for it (such as the /_create arguments).
+    """
+    new = {}
+    for field in TEXT_FIELDS + ["notes"]:
+        value = fields.get(field)
+        new[field] = value.strip() if isinstance(value, str) else value
+    for field in BOOLEAN_FIELDS:
+        new[field] = interp_bool(fields.get(field))
+    location = location_from(fields.get("latitude"), fields.get("longitude"))
+    if location:
+        new["location"] = location
+    new["verified"] = verified
+    new["version"] = 1
+    new["name_key"] = name_key(new["type"], new["name"])
+    return new
+
+
+def public_record(document, with_ids=False):
+    """
+    Returns a resource document as sent to the front end: without
+    its hidden fields, but, if with_ids (for volunteers), with its
+    id as text and its moderation fields.
+    """
+    record = {field: value for field, value in document.items()
+              if field not in HIDDEN_FIELDS}
+    if with_ids:
+        record["id"] = str(document["_id"])
+        for field in MODERATION_FIELDS:
+            if field in document:
+                record[field] = document[field]
+    return record
+
+
+def disp_query(resource_type, filter_fields=()):
+    """
+    Returns the mongo query for the verified resources of a type,
+    restricted to records with every field in filter_fields set.
+    """
+    query = {"type": resource_type, "verified": True}
+    for field in filter_fields:
+        query[field] = True
+    return query
+
+
+def find_disp(collection, resource_type, filter_fields=(), projection=PUBLIC_PROJECTION):
+    """
+    Returns a cursor over the verified resources of a type,
+    filtered, projected and sorted by the database. With
+    projection=None, records keep their _id and version.
+    """
+    return collection.find(disp_query(resource_type, filter_fields),
+                           projection).sort(NAME_ORDER)
+
+
+def find_verified(collection):
+    """
+    Returns a cursor over all verified resources, by type and
+    then in name order, as they are listed by /_disp.
+    """
+    return collection.find({"verified": True}, PUBLIC_PROJECTION).sort(
+        [("type", pymongo.ASCENDING)] + NAME_ORDER)
+
+
+def nearby_pipeline(latitude, longitude, max_distance, resource_type=None,
+                    filter_fields=(), skip=0, limit=20):
+    """
+    Returns the aggregation pipeline for one page of the verified
+    resources within max_distance meters of a point, nearest first,
+    each with its "distance" in meters.
+    """
+    query = {"verified": True}
+    if resource_type:
+        query["type"] = resource_type
+    for field in filter_fields:
+        query[field] = True
+    return [
+        {"$geoNear": {
+            "near": location_from(latitude, longitude),
+            "distanceField": "distance",
+            "maxDistance": max_distance,
+            "query": query,
+            "spherical": True,
+            "key": "location",
+        }},
+        {"$skip": skip},
+        {"$limit": limit},
+        {"$project": PUBLIC_PROJECTION},
+    ]
+
+
+def encode_cursor(record):
+    """
+    Returns the opaque cursor for the page that follows record:
+    its (name, _id) sort key, as url-safe text.
+    """
+    key = json.dumps([record.get("name"), str(record["_id"])])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Returns the (name, _id) sort key held by a cursor made by
+    encode_cursor. Raises ValueError if the cursor is malformed.
+    """
+    try:
+        name, record_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return name, bson.ObjectId(record_id)
+    except (TypeError, ValueError, bson.errors.InvalidId) as err:
+        raise ValueError("Malformed cursor: {}".format(err))
+
+
+def after_query(query, after):
+    """
+    Restricts query to the records that sort after the
+    (name, _id) key after, if one is given.
+    """
+    if after is None:
+        return query
+    name, record_id = after
+    query = dict(query)
+    query["$or"] = [{"name": {"$gt": name}},
+                    {"name": name, "_id": {"$gt": record_id}}]
+    return query
+
+
+def find_page(collection, query, limit=None, after=None):
+    """
+    Returns a cursor over the records matching query, in name
+    order, starting after the (name, _id) key after. When limit
+    is given, one extra record is fetched so the caller can tell
+    whether there is a next page. Records keep their _id, for the
+    caller to build the next cursor from.
+    """
+    cursor = collection.find(after_query(query, after)).sort(NAME_ORDER)
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    return cursor
+
+
+def read_page(cursor, limit=None, with_ids=False):
+    """
+    Reads a cursor from find_page into (records, next_cursor),
+    with the records as public_record gives them. next_cursor is
+    None on the last page.
+    """
+    records, next_cursor = split_page(cursor, limit)
+    return [public_record(record, with_ids) for record in records], next_cursor
+
+
+def split_page(cursor, limit=None):
+    """
+    Reads a cursor from find_page into (documents, next_cursor),
+    leaving the documents as they are.
+    """
+    records = list(cursor)
+    next_cursor = None
+    if limit and len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_cursor(records[-1])
+    return records, next_cursor
+
+
+def winning_plan(explanation):
+    """
+    Pulls the winning plan out of the output of cursor.explain(),
+    which is nested one level deeper by the slot based engine.
+    """
+    plan = explanation["queryPlanner"]["winningPlan"]
+    return plan.get("queryPlan", plan)
+
+
+def plan_stages(plan):
+    """
+    Returns the names of every stage in a query plan.
+    """
+    stages = [plan.get("stage")]
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = children + [plan["inputStage"]]
+    for child in children:
+        stages.extend(plan_stages(child))
+    return stages
+
+
+def explain_disp(collection, resource_type, filter_fields=()):
+    """
+    Explains the /_disp query for a type and filter combination.
+    Returns (ok, index_name, stages), where ok is True only if the
+    query is answered by an index scan, with no collection scan and
+    no in-memory sort.
+    """
+    plan = winning_plan(find_disp(collection, resource_type, filter_fields).explain())
+    stages = plan_stages(plan)
+    ok = ("IXSCAN" in stages
+          and "COLLSCAN" not in stages
+          and "SORT" not in stages)
+    index_name = None
+    node = plan
+    while node:
+        if node.get("stage") == "IXSCAN":
+            index_name = node.get("indexName")
+            break
+        node = node.get("inputStage")
+    return ok, index_name, stages
@@ -0,0 +1,118 @@
+"""
+The change feed behind /_changes, for clients and mirrors that keep
+a copy of the verified catalogue and want only what changed since
+they last looked.
+Every write to a resource stamps it with the next catalogue
+revision (rev), a number drawn from a counter document that only
+goes up, and every delete of a verified resource leaves a tombstone
+with a rev of its own; rejected submissions leave none, as they were
+never in the catalogue the feed describes.
+Both collections are indexed on rev, so the changes after a
+revision are read from the indexes, however big the catalogue is.
+A mirror starts from /_export, remembering the revision it was
+taken at (its X-Catalogue-Rev header), then asks for the changes
+since. Resources last written before revisions existed have none,
+and are only in the feed once written again.
+Revisions are drawn just before the write they stamp, so a write
+still in flight while the feed is read can land behind the rev the
+feed returned; a mirror that must never miss one asks again from a
+little before that rev, as changes are safe to apply twice.
+"""
+
+import datetime
+
+import pymongo  # Mongo database
+from pymongo import ReplaceOne, ReturnDocument
+
+import catalogue  # Resource queries and indexes
+
+# The counter document in the counters collection.
+COUNTER_ID = "rev"
+
+# The public fields of a changed resource, its id, and its revision.
+CHANGES_PROJECTION = {field: False for field in catalogue.HIDDEN_FIELDS
+                      if field not in ("_id", "rev")}
+
+# The feed's index on the tombstones collection; ensure_indexes
+# adds their expiry.
+TOMBSTONE_INDEXES = [pymongo.IndexModel([("rev", pymongo.ASCENDING)], name="rev")]
+
+
+def next_revs(counters, count=1):
+    """
+    Draws count revisions, all at once. Returns the first; the rest
+    follow it.
+    """
+    counter = counters.find_one_and_update({"_id": COUNTER_ID}, {"$inc": {"value": count}},
+                                           upsert=True, return_document=ReturnDocument.AFTER)
+    return counter["value"] - count + 1
+
+
+def current_rev(counters):
+    """
+    The last revision drawn, or 0 if none has been.
+    """
+    counter = counters.find_one({"_id": COUNTER_ID})
+    return counter["value"] if counter else 0
+
+
+def tombstones(records, first_rev, deleted_at):
+    """
+    Returns the tombstone documents of deleted records, with
+    revisions from first_rev on.
+    """
+    return [{"_id": record["_id"], "rev": first_rev + offset, "type": record.get("type"),
+             "deleted_at": deleted_at}
+            for offset, record in enumerate(records)]
+
+
+def record_deleted(tombstone_collection, counters, records):
+    """
+    Leaves tombstones for deleted records, which should be the
+    verified ones. Deleting a record again just moves its tombstone
+    to a later revision.
+    """
+    if not records:
+        return
+    stones = tombstones(records, next_revs(counters, len(records)),
+                        datetime.datetime.now(datetime.timezone.utc))
+    tombstone_collection.bulk_write([ReplaceOne({"_id": stone["_id"]}, stone, upsert=True)
+                                     for stone in stones], ordered=False)
+
+
+def ensure_indexes(tombstone_collection, ttl=None):
+    indexes = list(TOMBSTONE_INDEXES)
+    if ttl:
+        indexes.append(pymongo.IndexModel([("deleted_at", pymongo.ASCENDING)],
+                                          name="deleted_at_ttl", expireAfterSeconds=int(ttl)))
+    return tombstone_collection.create_indexes(indexes)
+
+
+def read_changes(resources, tombstone_collection, since, limit, resource_type=None):
+    """
+    Returns (updated, deleted, rev, more): the verified resources
+    (of resource_type, if given) written after revision since and
+    the tombstones of those deleted after it, at most limit of them
+    together, in revision order. rev is the last revision returned
+    (or since, if none was), and more whether there are further
+    changes after it.
+    """
+    query = {"rev": {"$gt": since}, "verified": True}
+    gone = {"rev": {"$gt": since}}
+    if resource_type:
+        query["type"] = resource_type
+        gone["type"] = resource_type
+    # The first limit changes of both are among the first limit of each.
+    written = list(resources.find(query, CHANGES_PROJECTION).sort("rev", pymongo.ASCENDING)
+                   .hint([("rev", pymongo.ASCENDING)]).limit(limit + 1))
+    removed = list(tombstone_collection.find(gone).sort("rev", pymongo.ASCENDING)
+                   .hint([("rev", pymongo.ASCENDING)]).limit(limit + 1))
+    merged = sorted([(document["rev"], True, document) for document in written] +
+                    [(tombstone["rev"], False, tombstone) for tombstone in removed],
+                    key=lambda change: change[0])
+    more = len(merged) > limit
+    merged = merged[:limit]
+    updated = [document for _, kept, document in merged if kept]
+    deleted = [tombstone for _, kept, tombstone in merged if not kept]
+    rev = merged[-1][0] if merged else since
+    return updated, deleted, rev, more
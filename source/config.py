@@ -23,6 +23,7 @@ Potential extensions:
 
 import configparser
 import argparse
+import functools
 import os
 import logging
 logging.basicConfig(format='%(levelname)s:%(message)s',
@@ -107,7 +108,7 @@ def imply_types(ns: dict):
             ns[var] = int(val)
 
 
-def configuration(proxied=False):
+def configuration(proxied=False, config_file=None):
     """
     Returns namespace (that is, object) of configuration
     values, giving precedence to command line arguments over
@@ -117,6 +118,9 @@ def configuration(proxied=False):
     configuration must come from the config.ini file.  A proxy
     like gunicorn may not use some some configuration values,
     such as the PORT.
+
+    config_file, like the -C option, names one more file to
+    read after the others.
     """
     log.debug("-> configuration")
     if proxied:
@@ -128,6 +132,8 @@ def configuration(proxied=False):
     config_file_paths = ["app.ini", "credentials.ini"]
     if cli_vars.get("config"):
         config_file_paths.append(cli_vars.get("config"))
+    if config_file:
+        config_file_paths.append(config_file)
     log.debug("Will read config files from '{}'".format(config_file_paths))
     config_for_project = cli_vars.get("project", None)
     ini = config_file_args(config_file_paths, config_for_project)
@@ -146,3 +152,11 @@ def configuration(proxied=False):
 
     return cli
 
+
+@functools.lru_cache(maxsize=None)
+def cached_configuration(proxied=False, config_file=None):
+    """
+    Like configuration(), but the files (and command line) are
+    read only once per process; later calls share the namespace.
+    """
+    return configuration(proxied, config_file)
@@ -0,0 +1,241 @@
+"""
+Database connection per server process.
+A MongoClient must not be carried across fork(): its sockets and
+monitor threads belong to the parent. Under gunicorn --preload the
+app is imported once in the master and then forked into workers,
+so the client is made lazily, the first time each process uses
+it, with pool and timeout settings from the configuration.
+
+Public catalogue reads may go to secondaries (mongo_read_preference,
+with a mongo_max_staleness bound). For a while after this process
+writes, they go to the primary instead, so what it caches and
+serves right after a write includes that write.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from pymongo import MongoClient, monitoring, read_preferences
+
+log = logging.getLogger(__name__)
+
+# Configuration variables, and the MongoClient option each one sets.
+CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_MAX_CONNECTING": "maxConnecting",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+}
+
+
+# Values of mongo_read_preference.
+READ_PREFERENCES = {
+    "primary": read_preferences.Primary,
+    "primaryPreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondaryPreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+# Seconds after a write that reads stay on the primary, unless the
+# staleness bound says otherwise. 90 is the smallest bound mongo allows.
+READ_FENCE = 90
+
+
+def client_options(config):
+    """
+    Returns the MongoClient options set in a configuration namespace.
+    """
+    options = {}
+    for variable, option in CLIENT_OPTIONS.items():
+        value = getattr(config, variable, None)
+        if value not in (None, ""):
+            options[option] = value
+    return options
+
+
+def read_preference(config):
+    """
+    Returns the read preference for public reads set in a
+    configuration namespace (the primary unless set).
+    """
+    name = getattr(config, "MONGO_READ_PREFERENCE", None) or "primary"
+    if name not in READ_PREFERENCES:
+        raise ValueError("Unknown mongo_read_preference {}".format(name))
+    if name == "primary":
+        return read_preferences.Primary()
+    staleness = getattr(config, "MONGO_MAX_STALENESS", None) or -1
+    return READ_PREFERENCES[name](max_staleness=staleness)
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Keeps count of this process's connections, for /_health.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.checkout_failures = 0
+
+    def _add(self, field, amount):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def connection_created(self, event):
+        self._add("open", 1)
+
+    def connection_closed(self, event):
+        self._add("open", -1)
+
+    def connection_checked_out(self, event):
+        self._add("in_use", 1)
+
+    def connection_checked_in(self, event):
+        self._add("in_use", -1)
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failures", 1)
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def stats(self):
+        with self._lock:
+            return {"open": self.open, "in_use": self.in_use,
+                    "idle": self.open - self.in_use,
+                    "checkout_failures": self.checkout_failures}
+
+
+class Database:
+    def __init__(self, url, name, options=None, listeners=(), on_connect=None,
+                 read_preference=None):
+        self.url = url
+        self.name = name
+        self.options = options or {}
+        self.listeners = list(listeners)
+        # Called with the database once each time a process makes its
+        # client, e.g. to make sure the indexes exist; if it fails, the
+        # error is logged and the client is used all the same.
+        self.on_connect = on_connect
+        # For collections asked for with secondary=True.
+        self.read_preference = read_preference or read_preferences.Primary()
+        staleness = getattr(self.read_preference, "max_staleness", -1)
+        self.fence = staleness if staleness > 0 else READ_FENCE
+        self._last_write = None
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self.pool = PoolMonitor()
+
+    def client(self):
+        """
+        Returns this process's MongoClient, making it on first use.
+        """
+        pid = os.getpid()
+        if self._client is not None and self._pid == pid:
+            return self._client
+        made = False
+        with self._lock:
+            if self._client is None or self._pid != pid:
+                # A client inherited from the parent is dropped, not
+                # closed: closing it would touch the parent's sockets.
+                self.pool = PoolMonitor()
+                self._client = MongoClient(self.url, connect=False,
+                                           event_listeners=self.listeners + [self.pool],
+                                           **self.options)
+                self._pid = pid
+                made = True
+            client = self._client
+        # Outside the lock, so that with mongo down the other threads
+        # are not all held up behind it.
+        if made and self.on_connect:
+            try:
+                self.on_connect(client[self.name])
+            except Exception as err:
+                log.warning("Setting up the database connection failed: {}".format(err))
+        return client
+
+    def db(self):
+        return self.client()[self.name]
+
+    def collection(self, name, secondary=False):
+        """
+        Returns a collection. With secondary=True, it is read with the
+        configured read preference, unless this process wrote recently.
+        """
+        collection = self.db()[name]
+        if secondary and not self.read_primary():
+            return collection.with_options(read_preference=self.read_preference)
+        return collection
+
+    def wrote(self):
+        """
+        Notes a write, keeping reads on the primary for a while.
+        """
+        self._last_write = time.monotonic()
+
+    def read_primary(self):
+        return (self._last_write is not None
+                and time.monotonic() - self._last_write < self.fence)
+
+    def reset(self):
+        """
+        Forgets the current client, so the next use makes a new one.
+        Called by gunicorn after forking each worker.
+        """
+        with self._lock:
+            self._client = None
+            self._pid = None
+
+    def health(self):
+        """
+        Pings the database; returns a dict describing the connection
+        pool of this process and whether the ping succeeded.
+        """
+        status = {"pid": os.getpid(), "pool": self.pool.stats(),
+                  "max_pool_size": self.options.get("maxPoolSize", 100),
+                  "read_preference": self.read_preference.mongos_mode,
+                  "reading_primary": self.read_primary()}
+        start = time.perf_counter()
+        try:
+            self.client().admin.command("ping")
+            status["ok"] = True
+        except Exception as err:
+            status["ok"] = False
+            status["error"] = str(err)
+        status["ping_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return status
+
+
+class LazyCollection:
+    """
+    Stands in for a collection of a Database, resolving it in the
+    current process on each use, so module level code can hold on
+    to it across fork().
+    """
+    def __init__(self, database, name, secondary=False):
+        self._database = database
+        self._name = name
+        self._secondary = secondary
+
+    def __getattr__(self, attribute):
+        return getattr(self._database.collection(self._name, self._secondary), attribute)
@@ -0,0 +1,166 @@
+"""
+Near-duplicate detection for resources.
+Each resource carries blocking keys (dup_keys, under a multikey
+index): its normalized phone number and email, and MinHash band
+signatures of the character trigrams of its name and address.
+Resources sharing a key are candidates; candidates are then scored
+on how alike their names and addresses really are. Bands of four
+MinHash rows make resources whose trigrams are about 70% the same
+likely to share a band, and ones under about 40% unlikely to.
+"""
+
+import hashlib
+import re
+import struct
+
+import catalogue  # Resource queries and indexes
+
+NUM_BANDS = 5
+ROWS_PER_BAND = 4
+NGRAM = 3
+# Candidates at least this alike (see similarity) are flagged.
+THRESHOLD = 0.5
+MAX_CANDIDATES = 50
+
+# What scoring needs of a candidate, and what the queue shows.
+CANDIDATE_PROJECTION = {"name": True, "address": True, "phone": True, "email": True,
+                        "type": True, "verified": True}
+
+# Fixed salts, so keys stay the same from one process to the next.
+_SALTS = [struct.pack("<I", i) for i in range(NUM_BANDS * ROWS_PER_BAND)]
+
+
+def phone_key(phone):
+    """
+    The last ten digits of a phone number, or None if it has fewer
+    than seven.
+    """
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) < 7:
+        return None
+    return digits[-10:]
+
+
+def email_key(email):
+    email = (email or "").strip().lower()
+    return email if "@" in email else None
+
+
+def ngrams(text):
+    """
+    The set of character trigrams of normalized text.
+    """
+    text = catalogue.normalize(text)
+    if not text:
+        return set()
+    padded = " {} ".format(text)
+    return {padded[i:i + NGRAM] for i in range(len(padded) - NGRAM + 1)}
+
+
+def shingles(record):
+    return ngrams(record.get("name")) | {"a" + gram for gram in ngrams(record.get("address"))}
+
+
+def _hash(salt, gram):
+    return int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8,
+                                          salt=salt).digest(), "little")
+
+
+def minhash_bands(grams):
+    """
+    Returns the band signatures of a set of trigrams.
+    """
+    if not grams:
+        return []
+    signature = [min(_hash(salt, gram) for gram in grams) for salt in _SALTS]
+    bands = []
+    for band in range(NUM_BANDS):
+        rows = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(struct.pack("<{}Q".format(ROWS_PER_BAND), *rows),
+                                 digest_size=8).hexdigest()
+        bands.append("m{}:{}".format(band, digest))
+    return bands
+
+
+def dup_keys(record):
+    """
+    Returns the blocking keys of a resource.
+    """
+    keys = []
+    phone = phone_key(record.get("phone"))
+    if phone:
+        keys.append("p:" + phone)
+    email = email_key(record.get("email"))
+    if email:
+        keys.append("e:" + email)
+    return keys + minhash_bands(shingles(record))
+
+
+def jaccard(first, second):
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def similarity(record, other):
+    """
+    Returns (score, reasons): how alike two resources are, from 0
+    to 1, and what matched. A shared phone or email counts as much
+    as a very similar name.
+    """
+    reasons = []
+    score = jaccard(ngrams(record.get("name")), ngrams(other.get("name")))
+    if score >= THRESHOLD:
+        reasons.append("name")
+    address = jaccard(ngrams(record.get("address")), ngrams(other.get("address")))
+    if address >= THRESHOLD:
+        reasons.append("address")
+        score = max(score, (score + address) / 2)
+    for field, key in (("phone", phone_key), ("email", email_key)):
+        if key(record.get(field)) and key(record.get(field)) == key(other.get(field)):
+            reasons.append(field)
+            score = max(score, 0.9)
+    return round(score, 3), reasons
+
+
+def find_duplicates(collection, record, limit=5):
+    """
+    Returns the resources that record looks like a duplicate of,
+    most alike first, as {"id", "name", "type", "verified", "score",
+    "reasons"} dicts. record needs its dup_keys.
+    """
+    keys = record.get("dup_keys") or dup_keys(record)
+    if not keys:
+        return []
+    query = {"dup_keys": {"$in": keys}}
+    if "_id" in record:
+        query["_id"] = {"$ne": record["_id"]}
+    found = []
+    for other in collection.find(query, CANDIDATE_PROJECTION).limit(MAX_CANDIDATES):
+        score, reasons = similarity(record, other)
+        if score >= THRESHOLD:
+            found.append({"id": str(other["_id"]), "name": other.get("name"),
+                          "type": other.get("type"), "verified": other.get("verified"),
+                          "score": score, "reasons": reasons})
+    found.sort(key=lambda duplicate: -duplicate["score"])
+    return found[:limit]
+
+
+def merged_fields(keep, drop):
+    """
+    Returns the $set that fills in the blanks of keep from drop,
+    joining their notes.
+    """
+    fields = {}
+    for field in catalogue.TEXT_FIELDS + catalogue.BOOLEAN_FIELDS + ["location"]:
+        if keep.get(field) in (None, "", "N/A") and drop.get(field) not in (None, "", "N/A"):
+            fields[field] = drop[field]
+    notes = [note for note in (keep.get("notes"), drop.get("notes")) if note]
+    if len(notes) == 2 and notes[0] != notes[1]:
+        fields["notes"] = "{}\n{}".format(*notes)
+    elif notes and not keep.get("notes"):
+        fields["notes"] = notes[0]
+    if fields:
+        merged = dict(keep, **fields)
+        fields["dup_keys"] = dup_keys(merged)
+    return fields
@@ -0,0 +1,156 @@
+"""
+The whole verified catalogue as a stream of rows, for /_export and
+utility/exportCatalogue.py: newline delimited JSON, one resource a
+line, or CSV with the loader's columns and the id.
+Resources are read in _id order straight from a mongo cursor, a
+batch at a time, and each row is written as soon as it is read, so
+memory stays the same however big the catalogue is. Every row
+carries the resource's id; an export that was cut short is resumed
+by asking for the resources after the last id received.
+"""
+
+import csv
+import io
+import zlib
+
+import bson  # ObjectIds, installed with pymongo
+import pymongo  # Mongo database
+from pymongo.errors import CursorNotFound
+
+import catalogue  # Resource queries and indexes
+import responses  # Cacheable, compressible JSON bodies
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# The loader's columns first, so utility/loadDB.py can load an export.
+CSV_COLUMNS = catalogue.COLUMNS + catalogue.OPTIONAL_COLUMNS + ["id"]
+# The public fields, and the id to resume after.
+EXPORT_PROJECTION = {field: False for field in catalogue.HIDDEN_FIELDS if field != "_id"}
+# Rows are sent in pieces of about this many bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_after(after):
+    """
+    Returns the ObjectId of an id to resume after, or None for none.
+    Raises ValueError if it is not an id.
+    """
+    if not after:
+        return None
+    try:
+        return bson.ObjectId(after)
+    except (TypeError, bson.errors.InvalidId) as err:
+        raise ValueError("Malformed id: {}".format(err))
+
+
+def export_query(resource_type=None, after=None):
+    query = {"verified": True}
+    if resource_type:
+        query["type"] = resource_type
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    return query
+
+
+def read_resources(collection, resource_type=None, after=None, batch_size=500):
+    """
+    Yields the verified resources (of resource_type, if given) after
+    the id after, in _id order. The walk follows the _id index, or
+    the type_verified_id index for one type, so the server neither
+    sorts nor holds more than a batch, nor reads other types. If the
+    server drops the cursor, because the rows were not taken for too
+    long, it carries on from the last resource read.
+    """
+    index = "type_verified_id" if resource_type else [("_id", pymongo.ASCENDING)]
+    while True:
+        cursor = collection.find(export_query(resource_type, after), EXPORT_PROJECTION)
+        cursor = cursor.sort("_id", pymongo.ASCENDING).hint(index)
+        try:
+            for document in cursor.batch_size(batch_size):
+                after = document["_id"]
+                yield document
+            return
+        except CursorNotFound:
+            continue
+
+
+def export_record(document):
+    """
+    Returns a resource as exported: its public fields and its id.
+    """
+    record = catalogue.public_record(document)
+    record["id"] = str(document["_id"])
+    return record
+
+
+def ndjson_rows(documents):
+    for document in documents:
+        yield responses.dumps(export_record(document)) + b"\n"
+
+
+def csv_value(value):
+    if value is True:
+        return "Yes"
+    if value is False:
+        return "No"
+    return "" if value is None else value
+
+
+def csv_rows(documents):
+    """
+    Yields the CSV header, then a row per resource, with yes/no
+    fields written as the spreadsheets have them.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def row(values):
+        writer.writerow(values)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text.encode("utf-8")
+
+    yield row(CSV_COLUMNS)
+    for document in documents:
+        record = export_record(document)
+        coordinates = (document.get("location") or {}).get("coordinates") or ["", ""]
+        record["longitude"], record["latitude"] = coordinates
+        yield row([csv_value(record.get(column)) for column in CSV_COLUMNS])
+
+
+def rows(documents, export_format):
+    """
+    Yields the rows of documents in export_format (see FORMATS).
+    """
+    if export_format == "csv":
+        return csv_rows(documents)
+    return ndjson_rows(documents)
+
+
+def chunked(pieces, size=CHUNK_SIZE):
+    """
+    Joins small pieces of bytes into chunks of about size bytes.
+    """
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def gzipped(chunks, level=6):
+    """
+    Compresses a stream of chunks into one gzip stream as it goes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
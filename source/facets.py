@@ -0,0 +1,158 @@
+"""
+How many verified resources there are of each type, and how many of
+those have each yes/no attribute (take OHP, monitor hormones and so
+on), for /_facets.
+The counts are kept in a small collection, one document per type:
+    {"_id": type, "count": n, "takes_OHP": n, ...}
+which the routes that verify and delete resources $inc as they go,
+so reading them touches a handful of documents rather than the
+catalogue. Counts that drift (from the loader, which writes to the
+database directly, from a merge, or from a crash between the two
+writes) are set right by reconcile(), which recounts the catalogue
+with one $facet aggregation, run every so often in the background.
+"""
+
+import logging
+import threading
+import time
+
+from pymongo import UpdateOne, ReplaceOne, DeleteMany  # Mongo database
+
+import catalogue  # Resource queries and indexes
+
+log = logging.getLogger(__name__)
+
+FIELDS = catalogue.BOOLEAN_FIELDS
+
+
+def increments(record, sign=1):
+    """
+    Returns the counts a verified record adds (sign 1) or takes
+    away (sign -1).
+    """
+    counts = {"count": sign}
+    for field in FIELDS:
+        if record.get(field) is True:
+            counts[field] = sign
+    return counts
+
+
+def change(counts, records, sign):
+    """
+    Adds (sign 1) or takes away (sign -1) verified records from the
+    counts collection, in one bulk write.
+    """
+    by_type = {}
+    for record in records:
+        totals = by_type.setdefault(record.get("type"), {})
+        for field, value in increments(record, sign).items():
+            totals[field] = totals.get(field, 0) + value
+    if by_type:
+        counts.bulk_write([UpdateOne({"_id": resource_type}, {"$inc": totals}, upsert=True)
+                           for resource_type, totals in by_type.items()], ordered=False)
+
+
+def facet_pipeline():
+    """
+    The aggregation counting the verified resources: one $facet
+    branch counts them by type, and one per attribute counts those
+    of each type that have it.
+    """
+    def per_type(*stages):
+        return list(stages) + [{"$group": {"_id": "$type", "n": {"$sum": 1}}}]
+
+    branches = {"count": per_type()}
+    for field in FIELDS:
+        branches[field] = per_type({"$match": {field: True}})
+    return [{"$match": {"verified": True}}, {"$facet": branches}]
+
+
+def recount(resources):
+    """
+    Returns the counts documents, by type, as the catalogue has them now.
+    """
+    documents = {}
+    for facets in resources.aggregate(facet_pipeline()):
+        for field, groups in facets.items():
+            for group in groups:
+                document = documents.setdefault(group["_id"], dict(
+                    {"_id": group["_id"], "count": 0}, **{name: 0 for name in FIELDS}))
+                document[field] = group["n"]
+    return documents
+
+
+def reconcile(resources, counts):
+    """
+    Replaces the counts with a fresh count of the catalogue. A write
+    counted between the aggregation and the replacement is lost
+    until the next reconcile.
+    """
+    documents = recount(resources)
+    ops = [ReplaceOne({"_id": resource_type}, document, upsert=True)
+           for resource_type, document in documents.items()]
+    ops.append(DeleteMany({"_id": {"$nin": list(documents)}}))
+    counts.bulk_write(ops, ordered=False)
+    log.debug("Facet counts reconciled for {} types".format(len(documents)))
+
+
+def summarize(documents):
+    """
+    Returns the /_facets result from the counts documents: the counts
+    of each type, and of all types together.
+    """
+    total = dict({"count": 0}, **{field: 0 for field in FIELDS})
+    types = {}
+    for document in documents:
+        if document.get("count", 0) <= 0:
+            continue
+        counts = {field: document.get(field, 0) for field in total}
+        types[document["_id"]] = counts
+        for field, value in counts.items():
+            total[field] += value
+    return {"total": total, "types": types}
+
+
+class FacetCounts:
+    def __init__(self, refresh=600):
+        self.refresh = refresh  # Seconds between reconciles
+        self._reconciled_at = None
+        self._reconciling = False
+        self._lock = threading.Lock()
+
+    def read(self, resources, counts):
+        """
+        Returns the /_facets result. The first read in a process
+        reconciles first if there are no counts yet; later reads
+        start a reconcile in the background once the last one is
+        older than the refresh interval.
+        """
+        if self._reconciled_at is None:
+            with self._lock:
+                if self._reconciled_at is None:
+                    if counts.find_one() is None:
+                        reconcile(resources, counts)
+                    self._reconciled_at = time.monotonic()
+        elif time.monotonic() - self._reconciled_at >= self.refresh and not self._reconciling:
+            self.reconcile_later(resources, counts)
+        return summarize(counts.find())
+
+    def reconcile_later(self, resources, counts):
+        """
+        Reconciles in a background thread, unless one already is.
+        """
+        with self._lock:
+            if self._reconciling:
+                return
+            self._reconciling = True
+
+        def run():
+            try:
+                reconcile(resources, counts)
+            except Exception as err:
+                log.warning("Facet counts reconcile failed: {}".format(err))
+            finally:
+                # Not retried before the next interval, even if it failed.
+                self._reconciled_at = time.monotonic()
+                self._reconciling = False
+
+        threading.Thread(target=run, daemon=True).start()
@@ -7,95 +7,382 @@ verified by users with appropriate privileges.
 """
 
 import sys
+import functools
 import logging
 import flask  # Web server tool.
-from werkzeug.security import generate_password_hash, check_password_hash  # User authentication.
-from pymongo import MongoClient  # Mongo database
+from werkzeug.middleware.proxy_fix import ProxyFix  # Client addresses behind nginx
+from pymongo import UpdateOne, ReturnDocument, IndexModel, ASCENDING  # Mongo database
+from pymongo.errors import DuplicateKeyError, OperationFailure
+import bson  # ObjectIds, installed with pymongo
 import config  # Get config settings from credentials file
+import database  # Mongo client per server process
+import catalogue  # Resource queries and indexes
+import dedupe  # Near-duplicate detection
+import cache  # Read-through cache for catalogue reads
+import responses  # Cacheable, compressible JSON bodies
+import fragments  # Each record's JSON, encoded once
+import search  # Full text search over resources
+import facets  # Counts of resources by type and attribute
+import export  # The catalogue as a stream of rows
+import changes  # Catalogue revisions for /_changes
+import passwords  # Password hashing in a process pool
+import bloom  # Username lookups without a database round trip
+import ratelimit  # Token bucket limits on the costly public endpoints
+import metrics  # Request and database metrics
 
 ####
-# App globals:
+# App globals, set by create_app:
 ###
-CONFIG = config.configuration()
+CONFIG = None
+app = None
+password_for_volunteers = None
+hasher = None
+usernames = None
+limiter = None
+catalogue_cache = None
+search_index = None
+disp_engine = None
+facet_counts = None
+record_fragments = None
+catalogue_snapshot = None
+catalogue_publisher = None
+request_metrics = None
+mongo_metrics = None
+shared_metrics = None
+mongo = None
+collection = None
+users_collection = None
+public_collection = None
+facet_collection = None
+counters_collection = None
+tombstone_collection = None
 
-MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
-    CONFIG.DB_USER,
-    CONFIG.DB_USER_PW,
-    CONFIG.DB_HOST,
-    CONFIG.DB_PORT,
-    CONFIG.DB)
+# The routes; create_app registers them on the app.
+bp = flask.Blueprint("transponder", __name__)
 
-if CONFIG.DEBUG is True:
-    print("Using URL '{}'".format(MONGO_CLIENT_URL))
+# Default rate limits of the costly endpoints anyone can call, as
+# "per client, global" rate/burst pairs (see ratelimit.py);
+# rate_limit_<name> in the configuration overrides them.
+RATE_LIMITS = {
+    "create": "0.2/10 5/50",
+    "register": "0.1/5 2/20",
+    "login": "0.5/10 20/40",
+    "checkname": "5/30 200/400",
+    "export": "0.01/3 0.1/5",
+}
 
-password_for_volunteers = CONFIG.PASSWORD_FOR_VOLUNTEERS
+# Most changes /_changes returns at once.
+CHANGES_LIMIT = 1000
 
-app = flask.Flask(__name__)
-app.secret_key = CONFIG.SECRET_KEY
+
+def create_app(configuration=None):
+    """
+    Makes the app, from a configuration namespace (by default the
+    configuration files, without the command line). Importing this
+    module does nothing else, and neither does this: the database
+    is first connected to by the first request that needs it.
+    """
+    global CONFIG, app, password_for_volunteers, hasher, usernames, limiter, catalogue_cache, search_index
+    global disp_engine, record_fragments, facet_counts, facet_collection, catalogue_snapshot, catalogue_publisher
+    global request_metrics, mongo_metrics, shared_metrics, mongo, collection, users_collection, public_collection
+    global counters_collection, tombstone_collection
+    CONFIG = configuration or config.cached_configuration(proxied=True)
+
+    MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+        CONFIG.DB_USER,
+        CONFIG.DB_USER_PW,
+        CONFIG.DB_HOST,
+        CONFIG.DB_PORT,
+        CONFIG.DB)
+
+    if CONFIG.DEBUG is True:
+        print("Using URL '{}'".format(MONGO_CLIENT_URL))
+
+    password_for_volunteers = CONFIG.PASSWORD_FOR_VOLUNTEERS
+
+    # Password hashing runs in a bounded pool of worker processes.
+    hasher = passwords.PasswordHasher(method=getattr(CONFIG, "HASH_METHOD", None),
+                                      salt_length=getattr(CONFIG, "HASH_SALT_LENGTH", 16),
+                                      workers=getattr(CONFIG, "HASH_WORKERS", 2),
+                                      max_queue=getattr(CONFIG, "HASH_QUEUE", 8),
+                                      timeout=getattr(CONFIG, "HASH_TIMEOUT", 10),
+                                      nice=getattr(CONFIG, "HASH_NICE", 10))
+
+    # The registered usernames, loaded on the first /_checkname.
+    usernames = bloom.UsernameFilter(capacity=getattr(CONFIG, "USERNAME_FILTER_CAPACITY", 100000),
+                                     refresh=getattr(CONFIG, "USERNAME_FILTER_REFRESH", 60))
+
+    # Rate limits, in buckets shared by the workers through
+    # rate_limit_store if it is set.
+    limiter = ratelimit.RateLimiter(
+        {name: ratelimit.parse_limits(getattr(CONFIG, "RATE_LIMIT_" + name.upper(), default))
+         for name, default in RATE_LIMITS.items()},
+        store=(ratelimit.SqliteStore(CONFIG.RATE_LIMIT_STORE)
+               if getattr(CONFIG, "RATE_LIMIT_STORE", None) else ratelimit.MemoryStore()))
+
+    app = flask.Flask(__name__)
+    app.secret_key = CONFIG.SECRET_KEY
+    app.register_blueprint(bp)
+    # Behind nginx, the client's address is in X-Forwarded-For.
+    if getattr(CONFIG, "TRUSTED_PROXIES", 0):
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(CONFIG.TRUSTED_PROXIES))
+
+    # Catalogue reads are cached per process, and invalidated by the
+    # routes that write to the catalogue.
+    catalogue_cache = cache.CatalogueCache(max_entries=getattr(CONFIG, "CACHE_SIZE", 256),
+                                           ttl=getattr(CONFIG, "CACHE_TTL", 300))
+
+    # The search index is loaded on the first search, kept up to date by
+    # the routes that write to the catalogue, and rebuilt periodically.
+    search_index = search.SearchIndex(refresh=getattr(CONFIG, "SEARCH_REFRESH", 300))
+
+    # Public /_disp queries are answered in process from a columnar copy
+    # of the verified catalogue, loaded on first use and rebuilt after
+    # writes to it and periodically.
+    disp_engine = None
+    if getattr(CONFIG, "QUERY_ENGINE", True):
+        import query_engine  # In-process /_disp over bitmap columns
+        disp_engine = query_engine.QueryEngine(refresh=getattr(CONFIG, "QUERY_ENGINE_REFRESH", 300))
+
+    # The counts behind /_facets are kept up to date by the routes that
+    # write to the catalogue, and recounted periodically.
+    facet_counts = facets.FacetCounts(refresh=getattr(CONFIG, "FACET_REFRESH", 600))
+
+    # The JSON of each resource, by id and version, for building responses.
+    record_fragments = fragments.FragmentStore(max_entries=getattr(CONFIG, "FRAGMENT_CACHE_SIZE", 20000))
+
+    # With snapshot_path set, the public /_disp and category reads are
+    # served from a snapshot file mapped by every worker, rebuilt in the
+    # background after the verified catalogue changes.
+    catalogue_snapshot = None
+    if getattr(CONFIG, "SNAPSHOT_PATH", None):
+        import snapshot  # Verified catalogue in a file shared by all workers
+        catalogue_snapshot = snapshot.SnapshotFile(CONFIG.SNAPSHOT_PATH,
+                                                   min_interval=getattr(CONFIG, "SNAPSHOT_MIN_INTERVAL", 5))
+
+    # With publish_dir set, the verified catalogue is also published there
+    # as static files (see publisher.py), and the categories a write touches
+    # are published again after it. publish_url is where the front end
+    # fetches them from.
+    catalogue_publisher = None
+    if getattr(CONFIG, "PUBLISH_DIR", None):
+        import publisher  # Verified catalogue as static files for a CDN
+        catalogue_publisher = publisher.Publisher(CONFIG.PUBLISH_DIR,
+                                                  min_interval=getattr(CONFIG, "PUBLISH_MIN_INTERVAL", 5))
+
+    # Per endpoint request metrics, and per command mongo metrics.
+    request_metrics = metrics.RequestMetrics()
+    mongo_metrics = metrics.MongoMetrics(slow_ms=getattr(CONFIG, "MONGO_SLOW_MS", 100))
+    # With metrics_dir set, each server process saves its figures
+    # there, and /_metrics reports those of all of them.
+    shared_metrics = None
+    if getattr(CONFIG, "METRICS_DIR", None):
+        shared_metrics = metrics.SharedMetrics(CONFIG.METRICS_DIR,
+                                               interval=getattr(CONFIG, "METRICS_SAVE_INTERVAL", 5))
+
+    # The client is made the first time each process uses the database,
+    # so gunicorn workers forked from a --preload master each get their
+    # own connection pool. Each new client makes sure /_disp can be
+    # answered from an index.
+    mongo = database.Database(MONGO_CLIENT_URL, str(CONFIG.DB),
+                              options=database.client_options(CONFIG),
+                              listeners=[mongo_metrics],
+                              on_connect=ensure_indexes,
+                              read_preference=database.read_preference(CONFIG))
+    # Writes, and reads that must see them, go to the primary.
+    collection = database.LazyCollection(mongo, "resources")
+    users_collection = database.LazyCollection(mongo, "users")
+    facet_collection = database.LazyCollection(mongo, "facet_counts")
+    counters_collection = database.LazyCollection(mongo, "counters")
+    tombstone_collection = database.LazyCollection(mongo, "tombstones")
+    # Public catalogue reads may be served by a secondary.
+    public_collection = database.LazyCollection(mongo, "resources", secondary=True)
+    return app
 
 
 ###
-# Database connection per server process:
+# Request metrics:
 ###
-try:
-    dbclient = MongoClient(MONGO_CLIENT_URL)
-    db = getattr(dbclient, str(CONFIG.DB))
-    collection = db.resources
-    users_collection = db.users
-except:
-    print("Failure opening database. Is Mongo running? Correct password?")
-    sys.exit(1)
+@bp.before_app_request
+def start_timer():
+    flask.g.request_started = request_metrics.start()
+
+
+@bp.after_app_request
+def record_request(response):
+    if "request_started" in flask.g:
+        # Streamed responses have no length until they are sent.
+        size = None if response.is_streamed else response.calculate_content_length()
+        # Labelled by view name, without the blueprint's prefix.
+        endpoint = (flask.request.endpoint or "unmatched").rpartition(".")[2]
+        request_metrics.finish(endpoint, response.status_code,
+                               flask.g.request_started, size)
+        if shared_metrics is not None:
+            shared_metrics.save_later(metrics_state)
+    return response
+
+
+# The plain counters at /_metrics, and what each counts.
+METRIC_COUNTERS = {
+    "catalogue_cache_total": "Catalogue cache lookups and removals.",
+    "rate_limited_total": "Requests refused by a rate limit.",
+}
+
+
+def metrics_state():
+    """
+    This process's figures, as plain data (see metrics.SharedMetrics).
+    """
+    cache_counts = catalogue_cache.stats()
+    return {
+        "requests": request_metrics.state(),
+        "mongo": mongo_metrics.state(),
+        "counters": {
+            "catalogue_cache_total": {kind: cache_counts[kind] for kind in
+                                      ("hits", "misses", "evictions", "invalidations")},
+            "rate_limited_total": {"{}_{}".format(*key): count
+                                   for key, count in limiter.refused.items()},
+        },
+    }
+
+
+# Metrics in the Prometheus text format, of every server process
+# if metrics_dir is set, otherwise of the one answering. Samples of
+# the slow queries are only shown to volunteers.
+@bp.route("/_metrics")
+def prometheus_metrics():
+    state = metrics_state()
+    states = [state]
+    if shared_metrics is not None:
+        shared_metrics.save(state)
+        states = shared_metrics.states() or states
+    requests, mongo_figures, counters = metrics.combine(states, slow_ms=mongo_metrics.slow_ms)
+    body = metrics.render(
+        requests.lines(),
+        mongo_figures.lines(samples=bool(flask.session.get("volunteer"))),
+        *[metrics.counter_lines(name, help_text, counters.get(name, {}))
+          for name, help_text in METRIC_COUNTERS.items()])
+    return flask.Response(body, mimetype="text/plain; version=0.0.4")
+
+
+# Liveness probe: pings the database and reports this worker's pool.
+@bp.route("/_health")
+def health():
+    status = mongo.health()
+    return flask.jsonify(result=status), (200 if status["ok"] else 503)
+
+
+def ensure_indexes(db):
+    """
+    Makes sure the indexes the app relies on exist; called as
+    each process connects.
+    """
+    catalogue.ensure_indexes(db.resources)
+    changes.ensure_indexes(db.tombstones, ttl=getattr(CONFIG, "TOMBSTONE_TTL", 90 * 24 * 3600))
+    try:
+        db.users.create_indexes(USER_INDEXES)
+    except OperationFailure as err:
+        # Most likely usernames registered twice before the index existed.
+        app.logger.warning("Could not make the unique username index: {}".format(err))
 
 
 ###
 # User account functionality:
 ###
+# One account per username.
+USER_INDEXES = [IndexModel([("username", ASCENDING)], name="username_unique", unique=True)]
+# What logging in needs of an account.
+USER_PROJECTION = {"_id": False, "username": True, "password": True, "userType": True}
+
+
 class User:
     def __init__(self, username, password, userType):
         self.username = username
         self.password = password  # Never storing the actual password, just a hash
         self.userType = userType
 
-    # ***ONLY EVER CALL WHEN CHAINED AND USING generate_password_hash(pword) ***
-    # such as: User(username, generate_password_hash(password), userType).save_to_db()
+    # ***ONLY EVER CALL WHEN CHAINED AND USING hasher.hash(pword) ***
+    # such as: User(username, hasher.hash(password), userType).save_to_db()
     # This means no passwords are ever saved in the database, only the hashs of the passwords
     def save_to_db(self):
-        app.logger.debug("Checking if user exists")
-        if find_by_username(self.username):
+        app.logger.debug("Creating new user")
+        new = {
+            "username": self.username,
+            "password": self.password,
+            "userType": self.userType,
+        }
+        # The unique index refuses a username already taken, even by
+        # a registration running at the same moment.
+        try:
+            users_collection.insert_one(new)
+        except DuplicateKeyError:
             app.logger.debug("User Already Exists")
             return False
-        else:
-            app.logger.debug("Creating new user")
-            new = {
-                "username": self.username,
-                "password": self.password,
-                "userType": self.userType,
-            }
-            res = users_collection.insert(new)
-            if hasattr(res, "writeConcernError"):
-                app.logger.debug(res["writeConcernError"])
-                return False
-            elif hasattr(res, "writeError"):
-                app.logger.debug(res["writeError"])
-                return False
-            else:
-                app.logger.debug("Created")
-                return True
-                # end save_to_db
+        usernames.add(self.username)
+        app.logger.debug("Created")
+        return True
+        # end save_to_db
 
 
 # Find user by username, if it exists, return the record, if it doesn't, return False
 def find_by_username(uname):
-    app.logger.debug("Finding User: " + uname)
-    for record in users_collection.find({"username": uname}):
-        app.logger.debug(record['username'], record['userType'])
+    app.logger.debug("Finding User: " + str(uname))
+    record = users_collection.find_one({"username": uname}, USER_PROJECTION)
+    if record:
+        app.logger.debug("{} {}".format(record['username'], record['userType']))
         return User(record['username'], record['password'], record['userType'])
     return False
 # end find_by_username
 
 
+def username_taken(uname):
+    """
+    True if uname is registered. Names the username filter has
+    certainly never seen are answered without asking mongo.
+    """
+    usernames.ensure_loaded(
+        lambda: (record["username"] for record in
+                 users_collection.find({}, {"_id": False, "username": True})))
+    if not usernames.might_exist(uname):
+        return False
+    return users_collection.find_one({"username": uname}, {"_id": True}) is not None
+
+
+def rate_limited(name):
+    """
+    Route decorator: turns the request away with a 429 once its
+    client, or all clients together, have used up the rate limit
+    called name (see RATE_LIMITS).
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def limited(*args, **kwargs):
+            wait = limiter.check(name, flask.request.remote_addr)
+            if wait:
+                app.logger.debug("Rate limited {} from {}".format(name, flask.request.remote_addr))
+                response = flask.jsonify(result={"error": "Too many requests, please try again later"})
+                response.status_code = 429
+                response.headers["Retry-After"] = ratelimit.retry_after(wait)
+                return response
+            return view(*args, **kwargs)
+        return limited
+    return decorate
+
+
+def hasher_busy():
+    """
+    The response when the password hashing pool is saturated.
+    """
+    app.logger.debug("Password hashing pool is busy")
+    response = flask.jsonify(result={"error": "Server busy, please try again"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
 # App route to register a new user.
-@app.route('/_register')
+@bp.route('/_register')
+@rate_limited("register")
 def register_user():
     app.logger.debug("Checking Registration")
     # Get User information
@@ -111,8 +398,20 @@ def register_user():
     else:
         userType = "standard user"
 
+    # Don't spend a hash on a name that is already taken.
+    if username_taken(username):
+        app.logger.debug("Failed Registration")
+        return flask.jsonify(result={'error': "User failed"})
+
+    # Hash the password off the request thread; turn the
+    # request away if too many are already waiting.
+    try:
+        pwhash = hasher.hash(password)
+    except passwords.HasherBusy:
+        return hasher_busy()
+
     # Try and register user
-    if User(username, generate_password_hash(password), userType).save_to_db():
+    if User(username, pwhash, userType).save_to_db():
         app.logger.debug("Registration Successful")
         result = {'message': 'User registered successfully as ' + userType}
         return flask.jsonify(result=result)
@@ -124,13 +423,14 @@ def register_user():
 
 
 # App route to check inputted username.
-@app.route('/_checkname')
+@bp.route('/_checkname')
+@rate_limited("checkname")
 def check_user_name():
     app.logger.debug("Checking Name Availability")
     # Get User information
     username = flask.request.args.get('username', type=str)
 
-    if find_by_username(username):
+    if username_taken(username):
         app.logger.debug("User Exists")
         return flask.jsonify(result=True)
     else:
@@ -139,7 +439,8 @@ def check_user_name():
 
 
 # App route for user to log in.
-@app.route('/_login')
+@bp.route('/_login')
+@rate_limited("login")
 def login_user():
     app.logger.debug("Checking Login")
     username = flask.request.args.get('username', type=str)
@@ -149,8 +450,16 @@ def login_user():
     user = find_by_username(username)
     if user:
         # Make sure hashes match the password (no passwords are ever saved)
-        if check_password_hash(user.password, password):
+        try:
+            correct = hasher.check(user.password, password)
+        except passwords.HasherBusy:
+            return hasher_busy()
+        if correct:
             app.logger.debug("Correct Login")
+            if hasher.needs_rehash(user.password):
+                # Made with older settings: upgrade it now we know the password.
+                hasher.rehash_later(password, lambda pwhash: users_collection.update_one(
+                    {"username": username}, {"$set": {"password": pwhash}}))
             if user.userType == "volunteer":
                 # This is a volunteer user, note that in the session
                 # variable so user has access to unverified resources.
@@ -178,108 +487,87 @@ def login_user():
 # Pages
 ###
 # Main index page
-@app.route("/")
-@app.route("/index")
+@bp.route("/")
+@bp.route("/index")
 def index():
     if 'volunteer' not in flask.session:
         flask.session["volunteer"] = False
     app.logger.debug("Main page entry")
-    return flask.render_template('index.html')
+    return flask.render_template('index.html',
+                                 publish_url=getattr(CONFIG, "PUBLISH_URL", None) or None)
 
 
 # Route to log in to the page.
-@app.route("/register")
+@bp.route("/register")
 def register():
     app.logger.debug("registration Page")
     return flask.render_template('registration.html')
 
 
 # Route to submit a new resource.
-@app.route("/submit")
+@bp.route("/submit")
 def submit():
     app.logger.debug("Submission Page")
     return flask.render_template('submit.html')
 
 
 # A function to display resources to the front end from the db.
-@app.route("/_disp")
+@bp.route("/_disp")
 def disp():
     resource_type = flask.request.args.get('res_type')
-    filter_ohp = False
-    if flask.request.args.get('filter_ohp') == "True":
-        filter_ohp = True
-    filter_monitor_hormones = False
-    if flask.request.args.get('filter_monitor_hormones') == "True":
-        filter_monitor_hormones = True
-    filter_pvt_ins = False
-    if flask.request.args.get('filter_pvt_ins') == "True":
-        filter_pvt_ins = True
     if resource_type:
         app.logger.debug("Pulling resources of type: " + resource_type)
-        result = {"resources": get_db_entries(resource_type, filter_ohp, filter_monitor_hormones, filter_pvt_ins)}
-        return flask.jsonify(result=result)
+        filter_fields = get_filter_fields(flask.request.args)
+        try:
+            limit, after = get_page_args()
+        except ValueError:
+            return flask.jsonify(result={"error": "Bad page cursor"})
+        query = catalogue.disp_query(resource_type, filter_fields)
+        if flask.request.args.get('stream') == "True":
+            return stream_page(query, limit, after)
+        if limit or after:
+            return cached_body(("disp", resource_type, filter_fields, limit, after),
+                               lambda: page_body(query, limit, after))
+        shared = current_snapshot()
+        if shared:
+            return send_body(shared.disp_body(resource_type, filter_fields))
+        return cached_body(("disp", resource_type, filter_fields),
+                           lambda: disp_body(resource_type, filter_fields))
     else:
         return flask.jsonify(dict())
 
 # Function to add a new resource to the db:
-@app.route("/_create")
+@bp.route("/_create")
+@rate_limited("create")
 def create():
     app.logger.debug("Uploading new resource to db.")
-    # Get resource contents from user.
-    type = flask.request.args.get('type')
-    name = flask.request.args.get('name')
-    office_name = flask.request.args.get('office_name')
-    address = flask.request.args.get('address')
-    phone = flask.request.args.get('phone')
-    email = flask.request.args.get('email')
-    website = flask.request.args.get('website')
-    takes_ohp = interp_bool(flask.request.args.get('takes_OHP'))
-    takes_private_ins = interp_bool(flask.request.args.get('takes_private_ins'))
-    sliding_scale = interp_bool(flask.request.args.get('sliding_scale'))
-    diversity_aware = interp_bool(flask.request.args.get('diversity_aware'))
-    paperwork_not_only_mf = interp_bool(flask.request.args.get('paperwork_not_only_mf'))
-    paperwork_asks_for_pronoun = interp_bool(flask.request.args.get('paperwork_asks_for_pronoun'))
-    can_monitor_hormones = interp_bool(flask.request.args.get('can_monitor_hormones'))
-    notes = flask.request.args.get('notes')
     # Add a new entry to the database with the contents submitted by the user.
-    new = {
-        "type": type,
-        "name": name,
-        "office_name": office_name,
-        "address": address,
-        "phone": phone,
-        "email": email,
-        "website": website,
-        "takes_OHP": takes_ohp,
-        "takes_private_ins": takes_private_ins,
-        "sliding_scale": sliding_scale,
-        "diversity_aware": diversity_aware,
-        "paperwork_not_only_mf": paperwork_not_only_mf,
-        "paperwork_asks_for_pronoun": paperwork_asks_for_pronoun,
-        "can_monitor_hormones": can_monitor_hormones,
-        "notes": notes,
-        "verified": False
-        }
+    new = catalogue.new_resource(flask.request.args, verified=False)
+    # Resources it may duplicate, for the volunteers to merge.
+    new["dup_keys"] = dedupe.dup_keys(new)
+    new["duplicates"] = dedupe.find_duplicates(collection, new)
+    new["rev"] = next_rev()
 
-    if does_resource_exist(type, name):
+    # Inserted only if no resource has the same type and name; the
+    # unique index on name_key settles concurrent submissions.
+    try:
+        res = collection.update_one({"name_key": new["name_key"]},
+                                    {"$setOnInsert": new}, upsert=True)
+    except DuplicateKeyError:
+        res = None
+    if res is None or res.upserted_id is None:
         result = {"error": "Resource is already in the database"}
     else:
-        res = collection.insert(new)
-        if hasattr(res, "writeConcernError"):
-            app.logger.debug(res["writeConcernError"])
-            result = {"error": res["writeConcernError"]}
-        elif hasattr(res, "writeError"):
-            app.logger.debug(res["writeError"])
-            result = {"error": res["writeError"]}
-        else:
-            app.logger.debug("Resource Created")
-            result = {"message": "Resource created successfully"}
-            
+        app.logger.debug("Resource Created")
+        new["_id"] = res.upserted_id
+        catalogue_written(created=[new])
+        result = {"message": "Resource created successfully"}
+
     return flask.jsonify(result=result)
 
 
 # Delete a resource
-@app.route("/_del")
+@bp.route("/_del")
 def delete():
     if not flask.session["volunteer"]:
         # Only volunteers have access to this function.
@@ -290,12 +578,11 @@ def delete():
     del_resource(res_name)
 
     # Return to the remaining unverified resources:
-    result = {"resources": get_unverified()}
-    return flask.jsonify(result=result)
+    return send_body(unverified_body())
 
 
 # Get unverified resources.
-@app.route("/_unverified")
+@bp.route("/_unverified")
 def unverified():
     # Only accessible to volunteers users
     # such that they can go through unverified
@@ -303,147 +590,661 @@ def unverified():
     # them as appropriate.
     if not flask.session["volunteer"]:
         return flask.jsonify(result={"err": "err"})
-    result = {"resources": get_unverified()}
-    return flask.jsonify(result=result)
+    try:
+        limit, after = get_page_args()
+    except ValueError:
+        return flask.jsonify(result={"error": "Bad page cursor"})
+    if flask.request.args.get('stream') == "True":
+        return stream_page(UNVERIFIED_QUERY, limit, after, with_ids=True)
+    if limit or after:
+        return send_body(page_body(UNVERIFIED_QUERY, limit, after, with_ids=True))
+    return send_body(unverified_body())
 
 
 # verify a resource
-@app.route("/_verify")
+@bp.route("/_verify")
 def verify():
     if not flask.session["volunteer"]:
         # Only volunteers have access to this function.
-        return flask.jsonify(result={err: "err"})
+        return flask.jsonify(result={"err": "err"})
     # Get the name of the resource to verify from user input:
     res_name = flask.request.args.get('res_name')
     app.logger.debug("verifying resource")
     verify_resource(res_name)
     # Return to the remaining unverified resources:
-    result = {"resources": get_unverified()}
+    return send_body(unverified_body())
+
+
+# Verify many resources at once, by id.
+@bp.route("/_verify_batch", methods=["GET", "POST"])
+def verify_batch():
+    if not flask.session.get("volunteer"):
+        # Only volunteers have access to this function.
+        return flask.jsonify(result={"err": "err"})
+    changed = moderate(get_ids(), "verify")
+    # Only what changed, not the whole queue:
+    result = {"verified": changed, "queue": count_unverified()}
+    return flask.jsonify(result=result)
+
+
+# Delete many resources at once, by id.
+@bp.route("/_del_batch", methods=["GET", "POST"])
+def delete_batch():
+    if not flask.session.get("volunteer"):
+        # Only volunteers have access to this function.
+        return flask.jsonify(result={"err": "err"})
+    changed = moderate(get_ids(), "delete")
+    # Only what changed, not the whole queue:
+    result = {"deleted": changed, "queue": count_unverified()}
+    return flask.jsonify(result=result)
+
+
+# Merge a resource into another it duplicates.
+@bp.route("/_merge", methods=["GET", "POST"])
+def merge():
+    if not flask.session.get("volunteer"):
+        # Only volunteers have access to this function.
+        return flask.jsonify(result={"err": "err"})
+    drop_id = flask.request.values.get('id', '')
+    keep_id = flask.request.values.get('into', '')
+    if not (bson.ObjectId.is_valid(drop_id) and bson.ObjectId.is_valid(keep_id)) or drop_id == keep_id:
+        return flask.jsonify(result={"error": "Two different resource ids are required"})
+    merged = merge_resources(bson.ObjectId(keep_id), bson.ObjectId(drop_id))
+    result = {"merged": [drop_id] if merged else [], "into": keep_id, "queue": count_unverified()}
     return flask.jsonify(result=result)
 
 
-@app.route("/_allcategories")
+# Everything the index page needs to start, in one request.
+@bp.route("/_bootstrap")
+def bootstrap():
+    resource_type = flask.request.args.get('res_type') or getattr(CONFIG, "DEFAULT_CATEGORY", None)
+    filter_fields = get_filter_fields(flask.request.args)
+    limit = flask.request.args.get('limit', 50, type=int)
+    limit = max(1, min(limit, getattr(CONFIG, "MAX_PAGE_SIZE", 500)))
+    if flask.session.get("volunteer"):
+        # The moderation queue size changes too often to cache.
+        return flask.jsonify(result=get_bootstrap(resource_type, filter_fields, limit, True))
+    return cached_json(("bootstrap", resource_type, filter_fields, limit),
+                       lambda: get_bootstrap(resource_type, filter_fields, limit, False))
+
+
+# Search verified resources by name, office, address and notes.
+@bp.route("/_search")
+def search_resources():
+    text = flask.request.args.get('q', '')
+    resource_type = flask.request.args.get('res_type') or None
+    filter_fields = get_filter_fields(flask.request.args)
+    limit = flask.request.args.get('limit', 20, type=int)
+    limit = max(1, min(limit, getattr(CONFIG, "MAX_PAGE_SIZE", 500)))
+    offset = max(0, flask.request.args.get('offset', 0, type=int))
+    search_index.ensure_loaded(lambda: public_collection.find({}))
+    records, total = search_index.search(text, resource_type, filter_fields,
+                                         limit=limit, offset=offset)
+    next_offset = offset + limit if offset + limit < total else None
+    result = {"resources": records, "total": total, "next": next_offset}
+    return flask.jsonify(result=result)
+
+
+# Verified resources near a point, nearest first.
+@bp.route("/_nearby")
+def nearby():
+    latitude = flask.request.args.get('lat', type=float)
+    longitude = flask.request.args.get('lng', type=float)
+    if catalogue.location_from(latitude, longitude) is None:
+        return flask.jsonify(result={"error": "A valid lat and lng are required"})
+    resource_type = flask.request.args.get('res_type') or None
+    filter_fields = get_filter_fields(flask.request.args)
+    max_distance = flask.request.args.get('max_distance', getattr(CONFIG, "NEARBY_MAX_DISTANCE", 50000),
+                                          type=float)
+    limit = flask.request.args.get('limit', 20, type=int)
+    limit = max(1, min(limit, getattr(CONFIG, "MAX_PAGE_SIZE", 500)))
+    offset = max(0, flask.request.args.get('offset', 0, type=int))
+    # One extra record, to tell whether there is another page.
+    pipeline = catalogue.nearby_pipeline(latitude, longitude, max_distance, resource_type,
+                                         filter_fields, skip=offset, limit=limit + 1)
+    records = list(catalogue_reader().aggregate(pipeline))
+    next_offset = offset + limit if len(records) > limit else None
+    result = {"resources": records[:limit], "next": next_offset}
+    return flask.jsonify(result=result)
+
+
+@bp.route("/_allcategories")
 def scrap_all_resource_list():
     """
     Scraps the collection to generate a list of all resource categories
     """
-    all_types = collection.distinct("type")
-    result = {"types": all_types}
-    print(result)
-    return flask.jsonify(result=result)
+    return cached_json(("categories", "all"),
+                       lambda: {"types": get_categories("all")})
 
 
-@app.route("/_verifiedcategories")
+@bp.route("/_verifiedcategories")
 def scrap_verified_resource_list():
     """
     Scraps the collection to generate a list of verified categories
     """
-    all_types = collection.distinct("type", {"verified": True})
-    result = {"types": all_types}
-    print(result)
-    return flask.jsonify(result=result)
+    shared = current_snapshot()
+    if shared:
+        return send_body(shared.categories_body())
+    return cached_json(("categories", "verified"),
+                       lambda: {"types": get_categories("verified")})
 
 
-@app.route("/_unverifiedcategories")
+@bp.route("/_unverifiedcategories")
 def scrap_unverified_resource_list():
     """
     Scraps the collection to generate a list of unverified categories
     """
-    all_types = collection.distinct("type", {"verified": False})
-    result = {"types": all_types}
-    print(result)
-    return flask.jsonify(result=result)
+    return cached_json(("categories", "unverified"),
+                       lambda: {"types": get_categories("unverified")})
+
+
+# Counts of the verified resources, by type and attribute.
+@bp.route("/_facets")
+def facet_count():
+    return flask.jsonify(result=facet_counts.read(collection, facet_collection))
+
+
+# The whole verified catalogue (or one category), streamed as
+# newline delimited JSON or CSV, gzipped if the client accepts it.
+# after resumes an export after the last id received.
+@bp.route("/_export")
+@rate_limited("export")
+def export_catalogue():
+    export_format = flask.request.args.get("format", "ndjson", type=str)
+    if export_format not in export.FORMATS:
+        return flask.jsonify(result={"error": "Unknown format"}), 400
+    try:
+        after = export.parse_after(flask.request.args.get("after", type=str))
+    except ValueError as err:
+        return flask.jsonify(result={"error": str(err)}), 400
+    resource_type = flask.request.args.get("res_type", type=str)
+
+    # Changes since this revision (see /_changes) bring the export up
+    # to date. Read from the primary, so the export has every write
+    # up to it, as a lagging secondary might not.
+    rev = changes.current_rev(counters_collection)
+    documents = export.read_resources(collection, resource_type, after,
+                                      batch_size=getattr(CONFIG, "EXPORT_BATCH_SIZE", 500))
+    body = export.chunked(export.rows(documents, export_format))
+    compress = bool(flask.request.accept_encodings["gzip"])
+    response = flask.Response(export.gzipped(body) if compress else body,
+                              mimetype=export.FORMATS[export_format])
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Content-Disposition"] = "attachment; filename=transponder.{}".format(export_format)
+    response.headers["X-Catalogue-Rev"] = str(rev)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+# The changes to the verified catalogue after revision since: the
+# resources written since (with their ids), the ids of those deleted
+# since, and the revision to ask from next time.
+@bp.route("/_changes")
+def catalogue_changes():
+    since = flask.request.args.get("since", 0, type=int)
+    limit = flask.request.args.get("limit", CHANGES_LIMIT, type=int)
+    limit = max(1, min(limit, CHANGES_LIMIT))
+    resource_type = flask.request.args.get("res_type", type=str)
+    updated, deleted, rev, more = changes.read_changes(
+        collection, tombstone_collection, since, limit, resource_type)
+    return flask.jsonify(result={
+        "rev": rev,
+        "more": more,
+        "updated": [export.export_record(document) for document in updated],
+        "deleted": [str(tombstone["_id"]) for tombstone in deleted],
+    })
+
+
+# Hit and miss counters for the catalogue cache and record fragments.
+@bp.route("/_cachestats")
+def cache_stats():
+    return flask.jsonify(result=dict(catalogue_cache.stats(), fragments=record_fragments.stats(),
+                                     usernames=usernames.stats(),
+                                     query_engine=disp_engine.stats() if disp_engine else None))
 
 
 # Error page(s)
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_not_found(error):
     app.logger.debug("Page not found")
     return flask.render_template('page_not_found.html',
                                  badurl=flask.request.base_url,
-                                 linkback=flask.url_for("index")), 404
+                                 linkback=flask.url_for("transponder.index")), 404
 
 
 ##############
 # Functions available to the page code above
 ##############
 
-def does_resource_exist(type, name):
+def disp_body(resource_type, filter_fields):
     """
-    Scraps the collection to see if the resource exists already
+    The body of a whole /_disp list: from the query engine if it
+    can answer, otherwise from mongo.
     """
-    for record in collection.find({"type": type, "name": name}):
-        app.logger.debug(record)
-        return True
-    return False
+    fragments = engine_fragments(resource_type, filter_fields)
+    if fragments is not None:
+        return responses.resources_body(fragments)
+    return record_fragments.body(get_db_entries(resource_type, filter_fields))
 
 
-def get_db_entries(resource_type, filter_ohp, filter_monitor_hormones, filter_pvt_ins):
+def engine_fragments(resource_type, filter_fields):
     """
-    Returns all matching resources, in a form that
-    can be inserted directly in the 'session' object,
-    in sorted order.
-    Can have three specified filter criteria,
-    which default to turned off.
+    Returns the encoded resources of a /_disp list from the query
+    engine, or None: if it is off or behind a write, and for
+    volunteers, who read their own moderation from the primary.
     """
-    records = []
-    for record in collection.find({"type": resource_type}):
-        matching_record = True
-        del record['_id']
-        if record["verified"] is False:
-            matching_record = False
-        if filter_ohp and not record["takes_OHP"]:
-            matching_record = False
-        if filter_monitor_hormones and not record["can_monitor_hormones"]:
-            matching_record = False
-        if filter_pvt_ins and not record["takes_private_ins"]:
-            matching_record = False
-        if matching_record:
-            records.append(record)
-    # Sort the records by name:
-    records.sort(key=lambda i: i['name'])
-    return records
+    if disp_engine is None or flask.session.get("volunteer"):
+        return None
+    disp_engine.ensure_loaded(snapshot_records)
+    if not disp_engine.fresh:
+        return None
+    return disp_engine.fragments(resource_type, filter_fields)
 
 
-def get_unverified():
+def get_db_entries(resource_type, filter_fields=()):
     """
-    Returns all unverified resources.
+    Returns a cursor over all matching resource documents,
+    with their _id and version, in sorted order, restricted
+    to those with every field in filter_fields set.
+    The filtering and sorting are all done by mongo,
+    against the indexes in catalogue.INDEXES.
     """
-    records = []
-    for record in collection.find({"verified": False}):
-        del record['_id']
-        records.append(record)
-    # Sort the records by name:
-    records.sort(key=lambda i: i['name'])
-    return records
+    return catalogue.find_disp(catalogue_reader(), resource_type, filter_fields, projection=None)
+
+
+def catalogue_reader():
+    """
+    Returns the collection to read the catalogue from for this
+    request. Volunteers read from the primary, so they see their
+    moderation at once; other visitors may read from a secondary.
+    """
+    if flask.session.get("volunteer"):
+        return collection
+    return public_collection
+
+
+def get_filter_fields(args):
+    """
+    Returns the tuple of resource fields required by the
+    /_disp filters turned on ("True") in args, in the order
+    of catalogue.DISP_FILTERS.
+    """
+    return tuple(field for arg, field in catalogue.DISP_FILTERS.items()
+                 if args.get(arg) == "True")
+
+
+def cached_json(key, build_result):
+    """
+    Responds with {"result": build_result()}, serialized once and
+    cached (with its compressed forms) under ("body", key) until
+    the data under key is invalidated. Requests that already hold
+    the current version get a 304 straight from the cache.
+    """
+    return cached_body(key, lambda: responses.JSONBody.of(result=build_result()))
+
+
+def cached_body(key, build_body):
+    """
+    Like cached_json, for a build_body() that makes the JSONBody.
+    Volunteers skip the cache (see catalogue_cached).
+    """
+    if not catalogue_cached():
+        return send_body(build_body())
+    return send_body(catalogue_cache.get(("body", key), build_body))
+
+
+def catalogue_cached():
+    """
+    Whether this request may use the cached catalogue reads. Not for
+    volunteers: the cache is shared with public visitors, may have
+    been filled from a secondary, and is invalidated only by the
+    writes of this process, so volunteers read from the primary to
+    see their moderation, and each other's, at once.
+    """
+    return not flask.session.get("volunteer")
+
+
+def send_body(body):
+    """
+    Responds with a prepared body (see responses.send).
+    """
+    return responses.send(body,
+                          min_size=getattr(CONFIG, "COMPRESS_MIN_SIZE", 1024),
+                          level=getattr(CONFIG, "COMPRESS_LEVEL", 6))
+
+
+def current_snapshot():
+    """
+    Returns the catalogue snapshot to answer this request from, or
+    None: if snapshots are off or none is built yet, and for
+    volunteers, who read their own moderation from the primary.
+    """
+    if catalogue_snapshot is None or flask.session.get("volunteer"):
+        return None
+    shared = catalogue_snapshot.current()
+    if shared is None:
+        catalogue_snapshot.rebuild_later(snapshot_records)
+    return shared
+
+
+def published_categories():
+    return collection.distinct("type", {"verified": True})
+
+
+def published_records(resource_type):
+    """
+    The verified resources of a type, as published.
+    """
+    return catalogue.find_disp(collection, resource_type)
+
+
+def snapshot_records():
+    """
+    The verified catalogue, as written to the snapshot and
+    loaded by the query engine.
+    """
+    return catalogue.find_verified(collection)
+
+
+# Queries behind each variant of the category routes.
+CATEGORY_QUERIES = {
+    "all": {},
+    "verified": {"verified": True},
+    "unverified": {"verified": False},
+}
+
+
+def get_categories(variant):
+    """
+    Returns the list of resource types in a category variant
+    ("all", "verified" or "unverified").
+    """
+    def read():
+        return catalogue_reader().distinct("type", CATEGORY_QUERIES[variant])
+
+    if not catalogue_cached():
+        return read()
+    return catalogue_cache.get(("categories", variant), read)
+
+
+def invalidate_catalogue(types=(), variants=()):
+    """
+    Drops the cached /_disp results for the given resource types,
+    and the cached category lists for the given variants.
+    Called after every write to the catalogue.
+    """
+    types = set(types)
+    variants = set(variants)
+
+    def stale(key):
+        if key[0] == "body":
+            # Serialized responses go stale with the data they hold.
+            key = key[1]
+        return ((key[0] == "disp" and key[1] in types)
+                or (key[0] == "categories" and key[1] in variants)
+                or (key[0] == "bootstrap" and (key[1] in types or "verified" in variants)))
+
+    catalogue_cache.invalidate(stale)
+
+
+# The moderation queue.
+UNVERIFIED_QUERY = {"verified": False}
+
+
+def unverified_body():
+    """
+    Returns the body listing all unverified resources, sorted by name,
+    with their ids, as for every list only volunteers see.
+    """
+    return record_fragments.body(collection.find(UNVERIFIED_QUERY).sort(catalogue.NAME_ORDER),
+                                 with_ids=True)
+
+
+def count_unverified():
+    """
+    Returns the number of resources awaiting verification.
+    """
+    return collection.count_documents(UNVERIFIED_QUERY)
+
+
+def get_bootstrap(resource_type, filter_fields, limit, include_queue):
+    """
+    Returns the /_bootstrap result: the verified categories, the
+    first page of resource_type, and the moderation queue size if
+    include_queue. Each part is its own indexed query; one $facet
+    over the catalogue would read every document, and its branches
+    could not use the /_disp indexes.
+    """
+    result = {"types": sorted(get_categories("verified")), "res_type": resource_type}
+    if resource_type:
+        query = catalogue.disp_query(resource_type, filter_fields)
+        records, next_cursor = catalogue.read_page(
+            catalogue.find_page(catalogue_reader(), query, limit), limit)
+        result["resources"] = records
+        result["next"] = next_cursor
+    if include_queue:
+        result["queue"] = count_unverified()
+    return result
+
+
+def get_page_args():
+    """
+    Reads the keyset pagination arguments of the request: limit
+    (capped at max_page_size) and after (the "next" cursor of the
+    previous page, decoded). Raises ValueError for a bad cursor.
+    """
+    limit = flask.request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, getattr(CONFIG, "MAX_PAGE_SIZE", 500)))
+    after = flask.request.args.get('after')
+    if after:
+        return limit, catalogue.decode_cursor(after)
+    return limit, None
+
+
+def page_body(query, limit, after, with_ids=False):
+    """
+    Returns the body of one page of the resources matching query,
+    with the cursor for the next page (None on the last page).
+    """
+    documents, next_cursor = catalogue.split_page(
+        catalogue.find_page(catalogue_reader(), query, limit, after), limit)
+    return record_fragments.body(documents, with_ids, next=next_cursor)
+
+
+def stream_page(query, limit, after, with_ids=False):
+    """
+    Streams one page (or, without a limit, all) of the resources
+    matching query straight from the database cursor.
+    """
+    cursor = catalogue.find_page(catalogue_reader(), query, limit, after)
+    cursor = cursor.batch_size(getattr(CONFIG, "STREAM_BATCH_SIZE", 100))
+    return responses.stream(cursor, limit, with_ids, record_fragments.fragment)
 
 
 def del_resource(name):
     """
     Deletes a resource with a specified name from the database.
     """
-    for record in collection.find({"name": name}):
-        collection.delete_one(record)
+    deleted = []
+    for record in collection.find({"name": name}, MODERATION_PROJECTION):
+        # Only the request that really deleted it counts it as deleted.
+        if collection.delete_one(dict(UNCLAIMED, _id=record["_id"])).deleted_count:
+            deleted.append(record)
+    catalogue_written(deleted=deleted)
 
 
 def verify_resource(name):
     """
     Marks a resource as verified.
     """
-    # for record in collection.find({"name": name}):
-    collection.update_one({"name": name},
-                          {"$set": {"verified": True}})
+    # The record as it was before the update, to see what changed.
+    record = collection.find_one_and_update(dict(UNCLAIMED, name=name),
+                                            {"$set": {"verified": True, "rev": next_rev()},
+                                             "$inc": {"version": 1}},
+                                            projection=MODERATION_PROJECTION)
+    if record and not record.get("verified"):
+        catalogue_written(verified=[record])
 
-    
-def interp_bool(boolesque_string):
-    if boolesque_string == "yes":
-        return True
-    if boolesque_string == "N/A":
-        return boolesque_string
-    return False
+
+# Resources no batch delete has claimed (see moderate); the other
+# moderation writes leave claimed resources to the batch.
+UNCLAIMED = {"deleting": {"$exists": False}}
+
+# What the moderation functions need to know about a record.
+MODERATION_PROJECTION = dict({"type": True, "verified": True},
+                             **{field: True for field in facets.FIELDS})
+
+
+def get_ids():
+    """
+    Reads the resource ids of a batch request, given either as
+    repeated ids arguments or comma separated. Ids that are not
+    valid are ignored.
+    """
+    ids = []
+    for value in flask.request.values.getlist('ids'):
+        for text in value.split(","):
+            if bson.ObjectId.is_valid(text.strip()):
+                ids.append(bson.ObjectId(text.strip()))
+    return ids
+
+
+def moderate(ids, action):
+    """
+    Verifies ("verify") or deletes ("delete") the resources with
+    the given ids, in a fixed number of round trips however many
+    there are. The resources are first claimed with this request's
+    own token in one update_many, guarded so that a resource two
+    volunteers moderate at once is claimed by only one of them;
+    what carries the token is what this request changed. Returns
+    the ids of those resources.
+    """
+    if not ids:
+        return []
+    token = bson.ObjectId()
+    if action == "verify":
+        collection.update_many(dict(UNCLAIMED, _id={"$in": ids}, verified=False),
+                               {"$set": {"verified": True, "moderated_by": token},
+                                "$inc": {"version": 1}})
+        changed = list(collection.find({"_id": {"$in": ids}, "moderated_by": token},
+                                       MODERATION_PROJECTION))
+        if changed:
+            # Stamp each with its own revision, and drop the token.
+            first_rev = next_rev(len(changed))
+            collection.bulk_write([UpdateOne({"_id": record["_id"]},
+                                             {"$set": {"rev": first_rev + offset},
+                                              "$unset": {"moderated_by": ""}})
+                                   for offset, record in enumerate(changed)], ordered=False)
+            catalogue_written(verified=changed)
+    else:
+        collection.update_many(dict(UNCLAIMED, _id={"$in": ids}), {"$set": {"deleting": token}})
+        changed = list(collection.find({"_id": {"$in": ids}, "deleting": token},
+                                       MODERATION_PROJECTION))
+        if changed:
+            collection.delete_many({"_id": {"$in": ids}, "deleting": token})
+            catalogue_written(deleted=changed)
+    return [str(record["_id"]) for record in changed]
+
+
+def merge_resources(keep_id, drop_id):
+    """
+    Fills in the blanks of one resource from a duplicate of it, and
+    deletes the duplicate. Returns False if either is gone, or if
+    another request deleted the duplicate first or the resource to
+    keep while merging.
+    """
+    keep = collection.find_one({"_id": keep_id})
+    if not keep:
+        return False
+    # Only the request that really deleted the duplicate merges it.
+    drop = collection.find_one_and_delete(dict(UNCLAIMED, _id=drop_id))
+    if not drop:
+        return False
+    update = {"$inc": {"version": 1}, "$pull": {"duplicates": {"id": str(drop_id)}},
+              "$set": dict(dedupe.merged_fields(keep, drop), rev=next_rev())}
+    kept = collection.find_one_and_update({"_id": keep_id}, update,
+                                          return_document=ReturnDocument.AFTER)
+    if kept is None:
+        # The resource to keep was deleted in the meantime; put the
+        # duplicate back rather than lose both.
+        app.logger.warning("Merge target {} vanished; restoring {}".format(keep_id, drop_id))
+        collection.insert_one(drop)
+        return False
+    # Nothing is a duplicate of the deleted resource any more.
+    collection.update_many({"duplicates.id": str(drop_id)},
+                           {"$pull": {"duplicates": {"id": str(drop_id)}}, "$inc": {"version": 1}})
+    catalogue_written(deleted=[drop], updated=[kept])
+    return True
+
+
+def next_rev(count=1):
+    """
+    Draws count catalogue revisions for stamping writes (see
+    changes.py); returns the first.
+    """
+    return changes.next_revs(counters_collection, count)
+
+
+def catalogue_written(created=(), verified=(), deleted=(), updated=()):
+    """
+    Brings everything kept from the catalogue up to date after a
+    write. created holds the new resource documents; verified and
+    deleted hold the records affected as they were before the
+    write (with at least their _id, type and verified); updated
+    holds whole documents changed in place, as they are now.
+    """
+    # Keep this process reading from the primary until secondaries catch up.
+    mongo.wrote()
+    types = set()
+    variants = set()
+    for record in created:
+        # New resources are unverified, so only the
+        # unverified categories can have changed.
+        variants.update(["all", "unverified"])
+        search_index.add(record)
+    for record in verified:
+        types.add(record.get("type"))
+        variants.update(["verified", "unverified"])
+        search_index.set_verified(record["_id"])
+    for record in deleted:
+        variants.add("all")
+        if record.get("verified"):
+            types.add(record.get("type"))
+            variants.add("verified")
+        else:
+            variants.add("unverified")
+        search_index.remove(record["_id"])
+    for record in updated:
+        if record.get("verified"):
+            types.add(record.get("type"))
+            variants.add("verified")
+        search_index.add(record)
+    invalidate_catalogue(types, variants)
+    # Rejected submissions were never in the verified catalogue.
+    published = [record for record in deleted if record.get("verified")]
+    changes.record_deleted(tombstone_collection, counters_collection, published)
+    facets.change(facet_collection, verified, 1)
+    facets.change(facet_collection, published, -1)
+    if updated:
+        # What an update changed is not known; recount.
+        facet_counts.reconcile_later(collection, facet_collection)
+    if disp_engine is not None and "verified" in variants:
+        disp_engine.invalidate()
+    if catalogue_snapshot is not None and "verified" in variants:
+        catalogue_snapshot.rebuild_later(snapshot_records)
+    if catalogue_publisher is not None and types:
+        catalogue_publisher.publish_later(published_categories, published_records, types)
 
 
 if __name__ == "__main__":
+    create_app(config.cached_configuration())
+    try:
+        mongo.client().admin.command("ping")
+    except Exception:
+        print("Failure opening database. Is Mongo running? Correct password?")
+        sys.exit(1)
     app.debug = CONFIG.DEBUG
     app.logger.setLevel(logging.DEBUG)
     app.run(port=CONFIG.PORT, host="localhost")
@@ -0,0 +1,57 @@
+"""
+Pre-encoded record fragments.
+Each resource's JSON is encoded once and kept as bytes, keyed by
+its _id and version. Every write to a resource bumps its version,
+so a fragment never goes stale: a changed record simply misses,
+and its old fragment ages out. Responses listing resources are
+put together by joining fragments (see responses.resources_body)
+instead of serializing every record again.
+"""
+
+import threading
+from collections import OrderedDict
+
+import catalogue  # Resource queries and indexes
+import responses  # Cacheable, compressible JSON bodies
+
+
+class FragmentStore:
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self._fragments = OrderedDict()  # (_id, version, with_ids) -> bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def fragment(self, document, with_ids=False):
+        """
+        Returns the JSON of a resource document as sent to the front
+        end (see catalogue.public_record).
+        """
+        key = (document["_id"], document.get("version", 0), with_ids)
+        with self._lock:
+            data = self._fragments.get(key)
+            if data is not None:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = responses.dumps(catalogue.public_record(document, with_ids))
+        with self._lock:
+            self._fragments[key] = data
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+        return data
+
+    def body(self, documents, with_ids=False, **extra):
+        """
+        Returns the JSONBody of {"result": {"resources": [...]}} for
+        resource documents (with their _id and version), plus any
+        extra members of "result".
+        """
+        return responses.resources_body(
+            [self.fragment(document, with_ids) for document in documents], **extra)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._fragments), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,38 @@
+"""
+gunicorn settings for serving the app:
+   cd source; gunicorn -c gunicorn.conf.py wsgi:app
+The app is imported once in the master and forked into the workers.
+Each worker opens its own database connection pool on first use;
+post_fork makes sure none is carried over from the master. With
+metrics_dir set, the workers' saved metrics are cleared as the
+server starts, and each worker saves its last figures as it exits.
+"""
+
+import multiprocessing
+import os
+import sys
+
+bind = os.environ.get("BIND", "127.0.0.1:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+preload_app = True
+# Threads per worker, so a long /_export stream ties up one thread
+# rather than a whole worker.
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+
+def on_starting(server):
+    app_module = sys.modules.get("flask_main")
+    if app_module is not None and app_module.shared_metrics is not None:
+        app_module.shared_metrics.clear()
+
+
+def post_fork(server, worker):
+    app_module = sys.modules.get("flask_main")
+    if app_module is not None:
+        app_module.mongo.reset()
+
+
+def worker_exit(server, worker):
+    app_module = sys.modules.get("flask_main")
+    if app_module is not None and app_module.shared_metrics is not None:
+        app_module.shared_metrics.save(app_module.metrics_state())
@@ -0,0 +1,397 @@
+"""
+Request and database metrics, in the Prometheus text format.
+RequestMetrics records the latency, status and response size of
+each request per flask endpoint, and how much of the latency was
+spent waiting on mongo. MongoMetrics is a pymongo command listener
+that records each command's duration and documents returned, and
+keeps samples of the slowest queries, with the values in them
+redacted.
+
+Each server process keeps its own figures. Under gunicorn, with
+several workers, a scrape reaches one of them at random, so with
+metrics_dir set each process also saves its figures to a file of
+its own there (SharedMetrics), and /_metrics adds up all the files.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from pymongo import monitoring
+
+# Histogram bucket upper bounds.
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+DOCUMENT_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+
+PREFIX = "transponder_"
+
+log = logging.getLogger(__name__)
+
+# Time spent in mongo commands by the request on this thread.
+_request_db = threading.local()
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def state(self):
+        return {"counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def merge(self, state):
+        """
+        Adds in another process's histogram, as state() gives it.
+        """
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, state["counts"])]
+        self.sum += state["sum"]
+        self.count += state["count"]
+
+    def lines(self, name, labels):
+        """
+        Returns the Prometheus text lines for this histogram.
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(name, label_text(labels, le=bound), cumulative))
+        lines.append("{}_sum{} {}".format(name, label_text(labels), self.sum))
+        lines.append("{}_count{} {}".format(name, label_text(labels), self.count))
+        return lines
+
+
+def label_text(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, escape(value))
+                          for key, value in sorted(labels.items())) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def header(name, kind, help_text):
+    return ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+
+
+class RequestMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}  # endpoint -> Histogram of seconds
+        self._db_time = {}  # endpoint -> Histogram of seconds spent in mongo
+        self._size = {}  # endpoint -> Histogram of response bytes
+        self._status = {}  # (endpoint, status) -> count
+
+    def start(self):
+        """
+        Called as a request starts. Returns its start time.
+        """
+        _request_db.seconds = 0.0
+        return time.perf_counter()
+
+    def finish(self, endpoint, status, started, size):
+        seconds = time.perf_counter() - started
+        db_seconds = getattr(_request_db, "seconds", 0.0)
+        with self._lock:
+            if endpoint not in self._latency:
+                self._latency[endpoint] = Histogram(LATENCY_BUCKETS)
+                self._db_time[endpoint] = Histogram(LATENCY_BUCKETS)
+                self._size[endpoint] = Histogram(SIZE_BUCKETS)
+            self._latency[endpoint].observe(seconds)
+            self._db_time[endpoint].observe(db_seconds)
+            if size is not None:
+                self._size[endpoint].observe(size)
+            key = (endpoint, status)
+            self._status[key] = self._status.get(key, 0) + 1
+
+    def state(self):
+        """
+        Returns these figures as plain data, for SharedMetrics.
+        """
+        with self._lock:
+            return {
+                "latency": {endpoint: h.state() for endpoint, h in self._latency.items()},
+                "db_time": {endpoint: h.state() for endpoint, h in self._db_time.items()},
+                "size": {endpoint: h.state() for endpoint, h in self._size.items()},
+                "status": [[endpoint, status, count]
+                           for (endpoint, status), count in self._status.items()],
+            }
+
+    def merge(self, state):
+        """
+        Adds in another process's figures, as state() gives them.
+        """
+        with self._lock:
+            for name, table, buckets in [("latency", self._latency, LATENCY_BUCKETS),
+                                         ("db_time", self._db_time, LATENCY_BUCKETS),
+                                         ("size", self._size, SIZE_BUCKETS)]:
+                for endpoint, histogram in state[name].items():
+                    table.setdefault(endpoint, Histogram(buckets)).merge(histogram)
+            for endpoint, status, count in state["status"]:
+                key = (endpoint, status)
+                self._status[key] = self._status.get(key, 0) + count
+
+    def lines(self):
+        lines = []
+        with self._lock:
+            for name, kind, help_text, table in [
+                    ("http_request_duration_seconds", "histogram",
+                     "Time to build each response, per endpoint.", self._latency),
+                    ("http_request_db_seconds", "histogram",
+                     "Time each request spent waiting on mongo, per endpoint.", self._db_time),
+                    ("http_response_size_bytes", "histogram",
+                     "Size of each response body, per endpoint.", self._size)]:
+                lines += header(PREFIX + name, kind, help_text)
+                for endpoint, histogram in sorted(table.items()):
+                    lines += histogram.lines(PREFIX + name, {"endpoint": endpoint})
+            lines += header(PREFIX + "http_responses_total", "counter",
+                            "Responses sent, per endpoint and status.")
+            for (endpoint, status), count in sorted(self._status.items()):
+                lines.append("{}http_responses_total{} {}".format(
+                    PREFIX, label_text({"endpoint": endpoint, "status": status}), count))
+        return lines
+
+
+class MongoMetrics(monitoring.CommandListener):
+    def __init__(self, slow_ms=100, samples=20):
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._started = {}  # request id -> (collection, query summary)
+        self._duration = {}  # command -> Histogram of seconds
+        self._documents = {}  # command -> Histogram of documents returned
+        self._failed = {}  # command -> count
+        self.slow_queries = 0
+        self.slow_samples = deque(maxlen=samples)
+
+    def started(self, event):
+        command = event.command
+        summary = command.get("filter", command.get("query", command.get("pipeline")))
+        with self._lock:
+            self._started[event.request_id] = (command.get(event.command_name), summary)
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        _request_db.seconds = getattr(_request_db, "seconds", 0.0) + seconds
+        documents = returned_documents(event.reply)
+        with self._lock:
+            collection, summary = self._started.pop(event.request_id, (None, None))
+            name = event.command_name
+            if name not in self._duration:
+                self._duration[name] = Histogram(LATENCY_BUCKETS)
+                self._documents[name] = Histogram(DOCUMENT_BUCKETS)
+            self._duration[name].observe(seconds)
+            if documents is not None:
+                self._documents[name].observe(documents)
+            if seconds * 1000 >= self.slow_ms:
+                self.slow_queries += 1
+                self.slow_samples.append((name, collection, seconds, documents,
+                                          str(redact(summary))[:200]))
+
+    def failed(self, event):
+        _request_db.seconds = getattr(_request_db, "seconds", 0.0) + event.duration_micros / 1e6
+        with self._lock:
+            self._started.pop(event.request_id, None)
+            self._failed[event.command_name] = self._failed.get(event.command_name, 0) + 1
+
+    def state(self):
+        """
+        Returns these figures as plain data, for SharedMetrics.
+        """
+        with self._lock:
+            return {
+                "duration": {name: h.state() for name, h in self._duration.items()},
+                "documents": {name: h.state() for name, h in self._documents.items()},
+                "failed": dict(self._failed),
+                "slow_queries": self.slow_queries,
+                "slow_samples": [list(sample) for sample in self.slow_samples],
+            }
+
+    def merge(self, state):
+        """
+        Adds in another process's figures, as state() gives them.
+        """
+        with self._lock:
+            for name, histogram in state["duration"].items():
+                self._duration.setdefault(name, Histogram(LATENCY_BUCKETS)).merge(histogram)
+            for name, histogram in state["documents"].items():
+                self._documents.setdefault(name, Histogram(DOCUMENT_BUCKETS)).merge(histogram)
+            for name, count in state["failed"].items():
+                self._failed[name] = self._failed.get(name, 0) + count
+            self.slow_queries += state["slow_queries"]
+            self.slow_samples.extend(tuple(sample) for sample in state["slow_samples"])
+
+    def lines(self, samples=False):
+        """
+        Returns the Prometheus text lines; with samples, followed by
+        the slow query samples, as comments.
+        """
+        lines = []
+        with self._lock:
+            lines += header(PREFIX + "mongo_command_duration_seconds", "histogram",
+                            "Duration of each mongo command, per command.")
+            for name, histogram in sorted(self._duration.items()):
+                lines += histogram.lines(PREFIX + "mongo_command_duration_seconds", {"command": name})
+            lines += header(PREFIX + "mongo_documents_returned", "histogram",
+                            "Documents returned by each mongo command, per command.")
+            for name, histogram in sorted(self._documents.items()):
+                lines += histogram.lines(PREFIX + "mongo_documents_returned", {"command": name})
+            lines += header(PREFIX + "mongo_command_failures_total", "counter",
+                            "Mongo commands that failed, per command.")
+            for name, count in sorted(self._failed.items()):
+                lines.append("{}mongo_command_failures_total{} {}".format(
+                    PREFIX, label_text({"command": name}), count))
+            lines += header(PREFIX + "mongo_slow_commands_total", "counter",
+                            "Mongo commands taking at least {} ms.".format(self.slow_ms))
+            lines.append("{}mongo_slow_commands_total {}".format(PREFIX, self.slow_queries))
+            if not samples:
+                return lines
+            # The samples are not metrics, so they go out as comments.
+            for name, collection, seconds, documents, summary in self.slow_samples:
+                lines.append("# slow {} on {}: {:.1f} ms, {} documents, {}".format(
+                    name, collection, seconds * 1000, documents, summary))
+        return lines
+
+
+def redact(summary):
+    """
+    Returns a query filter or pipeline with every value replaced by
+    "?", keeping the field names and operators: enough to see which
+    query was slow, without the usernames or other data it held.
+    """
+    if isinstance(summary, dict):
+        return {key: redact(value) for key, value in summary.items()}
+    if isinstance(summary, (list, tuple)):
+        return [redact(value) for value in summary]
+    if summary is None:
+        return None
+    return "?"
+
+
+def returned_documents(reply):
+    """
+    Returns how many documents a command reply carries,
+    or None for commands that do not return documents.
+    """
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "values" in reply:  # distinct
+        return len(reply["values"])
+    return None
+
+
+def counter_lines(name, help_text, values):
+    """
+    Returns the Prometheus text lines for a set of plain counters,
+    given as a dict from a "kind" label to its value.
+    """
+    lines = header(PREFIX + name, "counter", help_text)
+    for kind, value in sorted(values.items()):
+        lines.append("{}{}{} {}".format(PREFIX, name, label_text({"kind": kind}), value))
+    return lines
+
+
+class SharedMetrics:
+    """
+    The figures of every server process on the host, each process
+    saving its own (as plain data) to a JSON file named for its pid
+    in directory. The files of processes that have exited are kept,
+    so totals do not go back when a worker is replaced; clear() is
+    for when the whole server starts.
+    """
+    def __init__(self, directory, interval=5):
+        self.directory = directory
+        self.interval = interval  # Least seconds between saves
+        self._saved_at = None
+        self._lock = threading.Lock()
+
+    def _path(self, pid):
+        return os.path.join(self.directory, "{}.json".format(pid))
+
+    def save(self, state):
+        """
+        Saves this process's state, replacing its file in one step.
+        """
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = self._path(os.getpid())
+                with open(path + ".tmp", "w") as out:
+                    json.dump(state, out)
+                os.replace(path + ".tmp", path)
+                self._saved_at = time.monotonic()
+            except (OSError, TypeError, ValueError) as err:
+                log.warning("Could not save metrics to {}: {}".format(self.directory, err))
+
+    def save_later(self, make_state):
+        """
+        Saves make_state() if the last save is older than the interval.
+        """
+        if self._saved_at is None or time.monotonic() - self._saved_at >= self.interval:
+            self.save(make_state())
+
+    def states(self):
+        """
+        Returns the saved state of every process.
+        """
+        states = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path) as saved:
+                    states.append(json.load(saved))
+            except (OSError, ValueError):
+                continue  # Replaced or removed while being read
+        return states
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def combine(states, slow_ms=100):
+    """
+    Adds up the states of several processes (see SharedMetrics).
+    Returns a RequestMetrics and a MongoMetrics holding the totals,
+    and the totals of the plain counters, by name and kind.
+    """
+    requests = RequestMetrics()
+    mongo = MongoMetrics(slow_ms=slow_ms)
+    counters = {}
+    for state in states:
+        requests.merge(state["requests"])
+        mongo.merge(state["mongo"])
+        for name, values in state["counters"].items():
+            totals = counters.setdefault(name, {})
+            for kind, value in values.items():
+                totals[kind] = totals.get(kind, 0) + value
+    return requests, mongo, counters
+
+
+def render(*sections):
+    """
+    Joins lists of lines into a Prometheus text format body.
+    """
+    return "\n".join(line for section in sections for line in section) + "\n"
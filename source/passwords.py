@@ -0,0 +1,166 @@
+"""
+Password hashing off the request thread.
+Hashing a password is deliberately slow, so it is done in a small
+pool of worker processes rather than on the thread serving the
+request. The number of hashes waiting for the pool is bounded;
+past that, requests are turned away at once (HasherBusy) rather
+than queueing behind a burst of logins. If a worker process dies,
+the pool is broken for good, so it is replaced and the hash tried
+once more.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+log = logging.getLogger(__name__)
+
+
+# How the hashing processes are started. "fork" would copy the
+# threaded server process, held locks and all.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class HasherBusy(Exception):
+    """
+    Raised when the hashing pool already has as much work queued
+    as it is allowed to.
+    """
+
+
+def hash_method(pwhash):
+    """
+    Returns the method part of a werkzeug password hash,
+    such as "pbkdf2:sha256:600000" or "scrypt:32768:8:1".
+    """
+    return pwhash.split("$", 1)[0]
+
+
+class PasswordHasher:
+    def __init__(self, method=None, salt_length=16, workers=2, max_queue=8, timeout=10, nice=10):
+        # method and salt_length are passed to generate_password_hash;
+        # None means werkzeug's default method.
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers  # 0 hashes on the calling thread instead
+        self.timeout = timeout
+        # Added to the workers' niceness, so that on a busy host the
+        # request threads get the CPU before the hashes do.
+        self.nice = nice
+        self._slots = threading.BoundedSemaphore(max(1, workers + max_queue))
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        # A pool is not usable across fork(), so each server
+        # process starts its own on first use.
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                # Started from a fork server, not forked from this
+                # process, whose other threads (request threads, pymongo
+                # monitors) may hold locks a forked child would inherit.
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(START_METHOD),
+                                                 initializer=os.nice, initargs=(self.nice,))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _discard(self, pool):
+        """
+        Drops a broken pool, so the next hash starts a new one.
+        Another thread may have replaced it already.
+        """
+        with self._pool_lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+        log.warning("Password hashing pool broke; starting a new one")
+        pool.shutdown(wait=False)
+
+    def _submit(self, pool, fn, *args):
+        """
+        Queues fn(*args) on pool and returns its future,
+        or raises HasherBusy if the queue is full.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = pool.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, fn, *args):
+        if self.workers <= 0:
+            return fn(*args)
+        for attempt in range(2):
+            pool = self._executor()
+            try:
+                return self._submit(pool, fn, *args).result(timeout=self.timeout)
+            except TimeoutError:
+                raise HasherBusy()
+            except BrokenProcessPool:
+                self._discard(pool)
+                if attempt:
+                    raise
+
+    def _hash_args(self, password):
+        if self.method:
+            return password, self.method, self.salt_length
+        return (password,)
+
+    def hash(self, password):
+        """
+        Returns the hash of password, made with the configured method.
+        """
+        return self._run(generate_password_hash, *self._hash_args(password))
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        True if pwhash was made with other settings than the
+        configured ones, and should be replaced at the next login.
+        """
+        if not self.method:
+            return False
+        method = hash_method(pwhash)
+        return method != self.method and not method.startswith(self.method + ":")
+
+    def rehash_later(self, password, save):
+        """
+        Hashes password with the configured method in the background,
+        then calls save(new_hash). Skipped if the pool is busy; the
+        upgrade is simply tried again at the next login.
+        """
+        if self.workers <= 0:
+            save(self.hash(password))
+            return
+
+        pool = self._executor()
+        try:
+            future = self._submit(pool, generate_password_hash, *self._hash_args(password))
+        except HasherBusy:
+            return
+        except BrokenProcessPool:
+            self._discard(pool)
+            return
+
+        def done(future):
+            try:
+                save(future.result())
+            except BrokenProcessPool:
+                self._discard(pool)
+            except Exception as err:
+                log.warning("Password hash upgrade failed: {}".format(err))
+
+        future.add_done_callback(done)
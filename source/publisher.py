@@ -0,0 +1,165 @@
+"""
+Publishes the public catalogue as static JSON files, so nginx or a
+CDN can serve it without reaching the app.
+
+For each verified category, the file holds every verified resource
+of that type, in /_disp order: what /_disp answers with no filters
+on. The front end applies the /_disp filters to it itself, since
+the resources carry the fields they test. Files are named by the
+SHA-1 of their content, so they never change once written and can
+be cached forever; a .json.gz is written beside each one for
+servers that send precompressed files. manifest.json, which should
+not be cached, maps each category to its file:
+  {"categories": "<sha1>.json",
+   "lists": {"<type>": "<sha1>.json", ...}}
+
+After a write, only the files of the categories it touched are
+made again. Files that neither the new nor the previous manifest
+refer to are removed, so clients holding the previous manifest
+can still fetch what it names.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import responses  # Cacheable, compressible JSON bodies
+
+log = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+
+
+def type_body(records):
+    """
+    Returns the /_disp body for all the verified records of one
+    type, given in /_disp order.
+    """
+    return responses.dumps({"result": {"resources": records}})
+
+
+class Publisher:
+    def __init__(self, directory, min_interval=5):
+        self.directory = directory
+        self.min_interval = min_interval  # Seconds between publishes
+        self._lock = threading.Lock()
+        self._pending = set()  # Types to publish; None in it means all
+        self._worker = None
+        self.publishes = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_manifest(self):
+        try:
+            with open(self._path(MANIFEST)) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return {"lists": {}}
+
+    def _replace(self, name, data):
+        temp = self._path("{}.{}.tmp".format(name, os.getpid()))
+        with open(temp, "wb") as out:
+            out.write(data)
+        os.replace(temp, self._path(name))
+
+    def _write_file(self, body):
+        """
+        Writes body under its content hash, unless it is already
+        there. Returns the file name.
+        """
+        name = hashlib.sha1(body).hexdigest() + ".json"
+        if not os.path.exists(self._path(name)):
+            self._replace(name + ".gz", gzip.compress(body, mtime=0))
+            self._replace(name, body)
+        return name
+
+    def publish(self, categories, load_type, types=None):
+        """
+        Publishes the verified categories, and the /_disp files of
+        the given types (all of them, if types is None). load_type(t)
+        returns the verified records of type t in /_disp order.
+        Processes publishing at once take turns.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._publish(set(categories), load_type, types)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.publishes += 1
+
+    def _publish(self, categories, load_type, types):
+        previous = self.read_manifest()
+        if "lists" not in previous:
+            types = None  # Published per filter combination before; start again
+        lists = {} if types is None else dict(previous["lists"])
+        for resource_type in (categories if types is None else types):
+            lists.pop(resource_type, None)
+            if resource_type in categories:
+                lists[resource_type] = self._write_file(type_body(list(load_type(resource_type))))
+        lists = {resource_type: name for resource_type, name in lists.items()
+                 if resource_type in categories}
+        manifest = {"built": time.time(), "lists": lists,
+                    "categories": self._write_file(
+                        responses.dumps({"result": {"types": sorted(categories)}}))}
+        self._replace(MANIFEST, json.dumps(manifest, sort_keys=True).encode("utf-8"))
+        self._prune(manifest, previous)
+
+    def _prune(self, *manifests):
+        keep = set()
+        for manifest in manifests:
+            if manifest.get("categories"):
+                keep.add(manifest["categories"])
+            keep.update(manifest.get("lists", {}).values())
+            for files in manifest.get("disp", {}).values():  # Per filter combination, before
+                keep.update(files.values())
+        for name in os.listdir(self.directory):
+            if name.endswith(".json.gz"):
+                published = name[:-len(".gz")]
+            elif name.endswith(".json") and name != MANIFEST:
+                published = name
+            else:
+                continue
+            if published not in keep:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    def publish_later(self, load_categories, load_type, types=None):
+        """
+        Publishes the given types (or all) in a background thread.
+        Requests made while a publish is waiting or running are
+        folded into one more publish once it is done.
+        """
+        with self._lock:
+            if types is None:
+                self._pending.add(None)
+            else:
+                self._pending.update(types)
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._publish_pending,
+                                            args=(load_categories, load_type), daemon=True)
+            self._worker.start()
+
+    def _publish_pending(self, load_categories, load_type):
+        while True:
+            time.sleep(self.min_interval)
+            with self._lock:
+                if not self._pending:
+                    self._worker = None
+                    return
+                types = None if None in self._pending else set(self._pending)
+                self._pending = set()
+            try:
+                self.publish(load_categories(), load_type, types)
+            except Exception as err:
+                log.warning("Publishing the catalogue failed: {}".format(err))
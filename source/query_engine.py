@@ -0,0 +1,179 @@
+"""
+In-process /_disp over the verified catalogue, held in columns.
+Each resource is kept only as its encoded JSON, in one list in
+/_disp order (by type, then name and id), so a resource's position
+in the list is also its place in any answer. Next to it, for each
+filter field and for each type, a bitmap (a python int) has bit i
+set when resource i has that flag or type. Answering a /_disp
+query is then one AND of the type's bitmap with each filter's,
+done by the interpreter a machine word at a time, and a walk over
+the set bits of the result in position order; no record is looked
+at, and no sort is needed. Each filter turned on adds one AND, so
+the time hardly grows with the number of filters.
+
+Like the search index, the engine is rebuilt in the background
+every so often to pick up other server processes' writes, and
+again soon after this process writes to the verified catalogue.
+Until that rebuild is in, the engine is not fresh, and /_disp asks
+mongo instead.
+"""
+
+import logging
+import re
+import threading
+import time
+
+import catalogue  # Resource queries and indexes
+import responses  # Cacheable, compressible JSON bodies
+
+log = logging.getLogger(__name__)
+
+# The fields a /_disp query can filter on.
+FILTER_FIELDS = tuple(catalogue.DISP_FILTERS.values())
+
+# The positions of the set bits in each byte value.
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+_NONZERO = re.compile(b"[^\x00]")
+
+
+def positions(bitmap):
+    """
+    Yields the positions of the set bits of bitmap, lowest first.
+    Runs of zero bytes are skipped by the regex engine, not python.
+    """
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for match in _NONZERO.finditer(data):
+        base = match.start() * 8
+        for bit in _BYTE_BITS[data[match.start()]]:
+            yield base + bit
+
+
+class Columns:
+    """
+    One build of the engine: the encoded resources and their
+    bitmaps. Never changed once built, so readers need no lock.
+    """
+    __slots__ = ("fragments", "types", "flags", "size")
+
+    def __init__(self, documents, encode=responses.encode_record):
+        # documents: the verified resources in /_disp order, as
+        # catalogue.find_verified gives them.
+        self.fragments = []
+        types = {}
+        flags = {field: [] for field in FILTER_FIELDS}
+        for position, document in enumerate(documents):
+            self.fragments.append(encode(document))
+            types.setdefault(document.get("type"), []).append(position)
+            for field in FILTER_FIELDS:
+                if document.get(field) is True:
+                    flags[field].append(position)
+        self.size = len(self.fragments)
+        self.types = {resource_type: bitmap_of(members) for resource_type, members in types.items()}
+        self.flags = {field: bitmap_of(members) for field, members in flags.items()}
+
+    def select(self, resource_type, filter_fields=()):
+        """
+        Returns the bitmap of the resources of resource_type with
+        every field in filter_fields set.
+        """
+        selected = self.types.get(resource_type, 0)
+        for field in filter_fields:
+            if not selected:
+                break
+            selected &= self.flags.get(field, 0)
+        return selected
+
+
+def bitmap_of(members):
+    """
+    Returns the bitmap with the bits at the given positions set.
+    """
+    data = bytearray((members[-1] // 8 + 1) if members else 0)
+    for position in members:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+
+class QueryEngine:
+    def __init__(self, refresh=300, min_interval=2):
+        self.refresh = refresh  # Seconds between rebuilds
+        self.min_interval = min_interval  # Least seconds between rebuilds after writes
+        self._columns = None
+        self._loaded_at = None
+        self._writes = 0  # Writes to the verified catalogue seen
+        self._built_writes = 0  # Of those, the ones before the last build began
+        self._rebuilding = False
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.rebuilds = 0
+
+    @property
+    def fresh(self):
+        """
+        False from a write to the verified catalogue until a build
+        begun after it is loaded.
+        """
+        return self._built_writes == self._writes
+
+    def load(self, documents, writes=None):
+        # Readers keep whichever build they started with.
+        columns = Columns(documents)
+        self._columns = columns
+        self._built_writes = self._writes if writes is None else writes
+        self._loaded_at = time.monotonic()
+        self.rebuilds += 1
+        log.debug("Query engine loaded with {} resources".format(columns.size))
+
+    def ensure_loaded(self, load_documents):
+        """
+        Loads the engine with load_documents() on first use, and
+        rebuilds it in a background thread once it is older than the
+        refresh interval, or is stale and older than min_interval.
+        """
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None:
+                    writes = self._writes
+                    self.load(load_documents(), writes)
+            return
+        age = time.monotonic() - self._loaded_at
+        due = age >= self.refresh or (not self.fresh and age >= self.min_interval)
+        if not due or self._rebuilding:
+            return
+        self._rebuilding = True
+        writes = self._writes
+
+        def rebuild():
+            try:
+                self.load(load_documents(), writes)
+            except Exception as err:
+                log.warning("Query engine rebuild failed: {}".format(err))
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def invalidate(self):
+        """
+        Marks the engine out of date, after a write to the verified
+        catalogue; the next query starts a rebuild.
+        """
+        self._writes += 1
+
+    def fragments(self, resource_type, filter_fields=()):
+        """
+        Returns the encoded JSON of each verified resource of
+        resource_type with every field in filter_fields set, in
+        /_disp order.
+        """
+        columns = self._columns
+        self.queries += 1
+        fragments = columns.fragments
+        return [fragments[position] for position in
+                positions(columns.select(resource_type, filter_fields))]
+
+    def stats(self):
+        columns = self._columns
+        return {"resources": columns.size if columns else 0,
+                "types": len(columns.types) if columns else 0,
+                "queries": self.queries, "rebuilds": self.rebuilds, "fresh": self.fresh}
@@ -0,0 +1,193 @@
+"""
+Token bucket rate limits, for the endpoints anyone can call that
+cost the server the most: registering, logging in, checking a
+username and submitting a resource.
+Each limited endpoint has two buckets per store: one per client
+address, so a single client cannot flood it, and one shared by
+every client, so that together they cannot overwhelm the database
+or the password hashing pool. A bucket holds up to burst tokens
+and refills at rate tokens a second; each request takes one, and
+is refused while the bucket is empty.
+Buckets live in the process (MemoryStore), or in a SQLite file
+every worker on the host shares (SqliteStore), so the limits hold
+however many gunicorn workers there are.
+"""
+
+import collections
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# rate: tokens added a second; burst: most tokens held.
+Limit = collections.namedtuple("Limit", ["rate", "burst"])
+
+
+def parse_limit(text):
+    """
+    Returns the Limit of "rate/burst", e.g. "0.5/10"; or None for
+    "" or "none", meaning no limit.
+    """
+    text = text.strip()
+    if not text or text.lower() == "none":
+        return None
+    rate, _, burst = text.partition("/")
+    return Limit(float(rate), float(burst or rate))
+
+
+def parse_limits(text):
+    """
+    Returns the (per client, global) Limits of a configuration value
+    such as "0.5/10 20/40".
+    """
+    parts = str(text).replace(",", " ").split()
+    if not parts:
+        return None, None
+    return parse_limit(parts[0]), parse_limit(parts[1]) if len(parts) > 1 else None
+
+
+def refill(tokens, updated, limit, now):
+    """
+    Returns the tokens a bucket holding tokens at updated holds now.
+    """
+    return min(limit.burst, tokens + (now - updated) * limit.rate)
+
+
+def wait_for(tokens, limit):
+    """
+    Returns the seconds until a bucket holding tokens has one.
+    """
+    return (1 - tokens) / limit.rate if limit.rate > 0 else 3600
+
+
+class MemoryStore:
+    """
+    Buckets in this process only.
+    """
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        # key: (tokens, updated), least recently touched first.
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, now=None):
+        """
+        Takes a token from the bucket key. Returns 0 if there was one,
+        else the seconds until there will be.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (limit.burst, now))
+            tokens = refill(tokens, updated, limit, now)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                return wait_for(tokens, limit)
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._prune()
+            return 0
+
+    def _prune(self):
+        # Forget the buckets touched longest ago; they have most
+        # likely refilled, and a forgotten bucket starts full anyway.
+        for _ in range(len(self._buckets) - self.max_keys // 2):
+            self._buckets.popitem(last=False)
+
+
+class SqliteStore:
+    """
+    Buckets in a SQLite file, shared by every process on the host.
+    If the file cannot be used, requests are let through rather than
+    refused.
+    """
+    def __init__(self, path, timeout=0.05, prune_every=1000):
+        self.path = path
+        self.timeout = timeout  # Seconds to wait for another process's lock
+        self.prune_every = prune_every
+        self._local = threading.local()
+        self._takes = 0
+
+    def _connection(self):
+        # sqlite3 connections are not shared by threads, nor carried
+        # over a fork.
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            local.connection, local.pid = connection, os.getpid()
+        return local.connection
+
+    def take(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?",
+                                         (key,)).fetchone()
+                tokens = refill(*row, limit, now) if row else limit.burst
+                wait = 0 if tokens >= 1 else wait_for(tokens, limit)
+                connection.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                                   (key, tokens - 1 if not wait else tokens, now))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as err:
+            log.warning("Rate limit store unavailable, not limiting: {}".format(err))
+            return 0
+        self._takes += 1
+        if self._takes % self.prune_every == 0:
+            self._prune(now)
+        return wait
+
+    def _prune(self, now, idle=3600):
+        try:
+            self._connection().execute("DELETE FROM buckets WHERE updated < ?", (now - idle,))
+        except sqlite3.Error:
+            pass
+
+
+class RateLimiter:
+    def __init__(self, limits, store=None):
+        # limits: {name: (per client Limit, global Limit)}; either may
+        # be None for no limit.
+        self.limits = limits
+        self.store = store or MemoryStore()
+        self.refused = collections.Counter()  # (name, "client" or "global"): count
+
+    def check(self, name, client):
+        """
+        Takes a token for a request to name from client. Returns 0 if
+        it may go ahead, else the seconds to wait before retrying.
+        The client's bucket is tried first, so one client being
+        refused does not use up the tokens everyone shares.
+        """
+        per_client, overall = self.limits.get(name, (None, None))
+        if per_client:
+            wait = self.store.take("{}:{}".format(name, client), per_client)
+            if wait:
+                self.refused[name, "client"] += 1
+                return wait
+        if overall:
+            wait = self.store.take(name, overall)
+            if wait:
+                self.refused[name, "global"] += 1
+                return wait
+        return 0
+
+
+def retry_after(wait):
+    """
+    The Retry-After header value for waiting wait seconds.
+    """
+    return str(max(1, int(math.ceil(wait))))
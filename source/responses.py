@@ -0,0 +1,161 @@
+"""
+Cacheable JSON response bodies.
+A JSONBody is serialized once, carries a strong ETag derived from
+its content, and keeps each compressed encoding of itself once it
+has been asked for, so a cached body is never re-serialized or
+re-compressed. Each encoding is a different representation, so it
+is sent with its own ETag: the content's, with the encoding added.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+
+import flask  # Web server tool.
+import catalogue  # Resource queries and indexes
+
+try:
+    import brotli  # Optional: better compression for clients that accept it
+except ImportError:
+    brotli = None
+
+try:
+    import orjson  # Optional: a much faster JSON encoder
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """
+    Serializes value the same way for every catalogue response, so
+    equal content always gets the same bytes (and the same ETag).
+    """
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+class JSONBody:
+    def __init__(self, data):
+        self.data = data  # The serialized (identity encoded) body
+        self.size = len(data)
+        self.etag = hashlib.sha1(data).hexdigest()
+        self._encoded = {}  # Content-Encoding -> compressed body
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, **kwargs):
+        """
+        Builds a body from keyword arguments, like flask.jsonify.
+        """
+        return cls(dumps(kwargs))
+
+    def encoded(self, encoding, level=6):
+        """
+        Returns the body compressed with encoding ("gzip" or "br").
+        """
+        with self._lock:
+            data = self._encoded.get(encoding)
+            if data is None:
+                if encoding == "br":
+                    data = brotli.compress(self.data, quality=min(level, 11))
+                else:
+                    data = gzip.compress(self.data, compresslevel=level, mtime=0)
+                self._encoded[encoding] = data
+            return data
+
+
+def resources_body(fragments, **extra):
+    """
+    Returns the JSONBody of {"result": {"resources": [...]}}, plus
+    any extra members of "result", given the resources already
+    encoded. The bytes are the same dumps() would give.
+    """
+    members = {key: dumps(value) for key, value in extra.items()}
+    members["resources"] = b"[" + b",".join(fragments) + b"]"
+    return JSONBody(b'{"result":{' + b",".join(
+        dumps(key) + b":" + members[key] for key in sorted(members)) + b"}}")
+
+
+def choose_encoding(request, body, min_size):
+    """
+    Picks the best compression the client accepts, or None if the
+    body is too small to be worth compressing.
+    """
+    if body.size < min_size:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+# The content codings a body may be sent in; None is identity.
+ENCODINGS = (None, "gzip", "br")
+
+
+def encoding_etag(body, encoding):
+    """
+    Returns the ETag of body sent with encoding (None for identity).
+    """
+    return body.etag if encoding is None else "{}-{}".format(body.etag, encoding)
+
+
+def send(body, request=None, min_size=1024, level=6):
+    """
+    Turns a JSONBody into a response for the current request:
+    a bodiless 304 if the client already has this version, in any
+    encoding, otherwise the body, compressed if the client allows it.
+    """
+    request = request or flask.request
+    encoding = choose_encoding(request, body, min_size)
+    if any(request.if_none_match.contains(encoding_etag(body, known)) for known in ENCODINGS):
+        response = flask.Response(status=304)
+    elif encoding:
+        response = flask.Response(body.encoded(encoding, level), mimetype="application/json")
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = flask.Response(body.data, mimetype="application/json")
+    response.set_etag(encoding_etag(body, encoding))
+    # Let browsers keep the body, but always check it is current.
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def encode_record(document, with_ids=False):
+    return dumps(catalogue.public_record(document, with_ids))
+
+
+def stream_resources(cursor, limit=None, with_ids=False, encode=encode_record):
+    """
+    Yields the JSON for {"result": {"resources": [...], "next": ...}}
+    record by record from a catalogue.find_page cursor, so the first
+    records go out before the last have been read from the database.
+    With with_ids, each record carries its id as text. encode(document,
+    with_ids) gives each record's JSON, e.g. FragmentStore.fragment.
+    """
+    yield b'{"result":{"resources":['
+    count = 0
+    last = None
+    next_cursor = None
+    for record in cursor:
+        if limit and count == limit:
+            # The extra record find_page fetched: there is another page.
+            next_cursor = catalogue.encode_cursor(last)
+            break
+        last = record
+        yield (b"," if count else b"") + encode(record, with_ids)
+        count += 1
+    yield b'],"next":' + dumps(next_cursor) + b"}}"
+
+
+def stream(cursor, limit=None, with_ids=False, encode=encode_record):
+    """
+    Returns a response that streams a catalogue.find_page cursor.
+    """
+    return flask.Response(stream_resources(cursor, limit, with_ids, encode),
+                          mimetype="application/json")
@@ -0,0 +1,268 @@
+"""
+In-process full text search over resources.
+An inverted index from word to the resources containing it, over
+the name, office name, address and notes of every resource, with
+matches weighted by field and by how rare the word is. The last
+word of a query also matches as a prefix, for type-ahead.
+
+The index is kept up to date by the routes that write to the
+catalogue in this process, and rebuilt in the background every
+so often to pick up writes made by other server processes.
+"""
+
+import bisect
+import logging
+import math
+import re
+import threading
+import time
+
+import catalogue  # Resource queries and indexes
+
+log = logging.getLogger(__name__)
+
+# Searched fields, and how much a match in each one counts.
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "office_name": 2.0,
+    "address": 1.0,
+    "notes": 0.5,
+}
+
+# The shortest last word expanded as a prefix, and the most
+# words a prefix is expanded to. Shorter words match exactly.
+MIN_PREFIX_LENGTH = 3
+MAX_PREFIX_EXPANSION = 200
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    if not isinstance(text, str):
+        return []
+    return WORD.findall(text.lower())
+
+
+class Entry:
+    """
+    What the index keeps for each resource: the public record
+    returned in results, plus what the filters need.
+    """
+    __slots__ = ("record", "type", "verified", "flags", "name")
+
+    def __init__(self, record):
+        self.record = catalogue.public_record(record)
+        self.type = record.get("type")
+        self.verified = record.get("verified") is True
+        self.flags = frozenset(key for key, value in record.items()
+                               if value is True and key != "verified")
+        self.name = record.get("name") or ""
+
+
+class SearchIndex:
+    def __init__(self, refresh=300):
+        self.refresh = refresh  # Seconds between background rebuilds
+        self._lock = threading.RLock()
+        self._entries = {}  # id -> Entry
+        self._postings = {}  # word -> {id: weight}
+        self._words = []  # Every indexed word, sorted, for prefix lookups
+        # The ids passing each filter, so filtering is done with set
+        # intersections rather than by looking at each candidate.
+        self._verified = set()
+        self._unverified = set()
+        self._by_type = {}  # type -> set of ids
+        self._by_flag = {}  # boolean field -> set of ids set to True
+        self._loaded_at = None
+        self._refreshing = False
+
+    ###
+    # Keeping the index up to date
+    ###
+    def _add(self, record_id, record, keep_words=True):
+        # keep_words=False leaves self._words for the caller to sort
+        # once, rather than inserting each new word in order.
+        entry = self._entries[record_id] = Entry(record)
+        (self._verified if entry.verified else self._unverified).add(record_id)
+        self._by_type.setdefault(entry.type, set()).add(record_id)
+        for flag in entry.flags:
+            self._by_flag.setdefault(flag, set()).add(record_id)
+        for field, weight in FIELD_WEIGHTS.items():
+            for word in tokenize(record.get(field)):
+                postings = self._postings.get(word)
+                if postings is None:
+                    postings = self._postings[word] = {}
+                    if keep_words:
+                        bisect.insort(self._words, word)
+                postings[record_id] = postings.get(record_id, 0.0) + weight
+
+    def _remove(self, record_id):
+        entry = self._entries.pop(record_id, None)
+        if entry is None:
+            return
+        self._verified.discard(record_id)
+        self._unverified.discard(record_id)
+        self._by_type.get(entry.type, set()).discard(record_id)
+        for flag in entry.flags:
+            self._by_flag[flag].discard(record_id)
+        for field in FIELD_WEIGHTS:
+            for word in tokenize(entry.record.get(field)):
+                postings = self._postings.get(word)
+                if postings is None:
+                    continue
+                postings.pop(record_id, None)
+                if not postings:
+                    del self._postings[word]
+                    del self._words[bisect.bisect_left(self._words, word)]
+
+    def add(self, record):
+        """
+        Adds (or replaces) a resource document, which must have its _id.
+        """
+        record_id = str(record["_id"])
+        with self._lock:
+            self._remove(record_id)
+            self._add(record_id, record)
+
+    def remove(self, record_id):
+        with self._lock:
+            self._remove(str(record_id))
+
+    def set_verified(self, record_id, verified=True):
+        with self._lock:
+            entry = self._entries.get(str(record_id))
+            if entry is not None:
+                entry.verified = verified
+                entry.record["verified"] = verified
+                (self._verified if verified else self._unverified).add(str(record_id))
+                (self._unverified if verified else self._verified).discard(str(record_id))
+
+    def load(self, records):
+        """
+        Replaces the whole index with the given resource documents.
+        The new index is built aside and swapped in, so searches
+        carry on against the old one meanwhile.
+        """
+        fresh = SearchIndex(self.refresh)
+        for record in records:
+            fresh._add(str(record["_id"]), record, keep_words=False)
+        fresh._words = sorted(fresh._postings)
+        with self._lock:
+            self._entries = fresh._entries
+            self._postings = fresh._postings
+            self._words = fresh._words
+            self._verified = fresh._verified
+            self._unverified = fresh._unverified
+            self._by_type = fresh._by_type
+            self._by_flag = fresh._by_flag
+            self._loaded_at = time.monotonic()
+        log.debug("Search index loaded with {} resources".format(len(self._entries)))
+
+    def ensure_loaded(self, load_records):
+        """
+        Loads the index with load_records() on first use, and
+        rebuilds it in a background thread once it is older
+        than the refresh interval.
+        """
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None:
+                    self.load(load_records())
+            return
+        if time.monotonic() - self._loaded_at < self.refresh or self._refreshing:
+            return
+        self._refreshing = True
+
+        def rebuild():
+            try:
+                self.load(load_records())
+            except Exception as err:
+                log.warning("Search index rebuild failed: {}".format(err))
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    ###
+    # Searching
+    ###
+    def _matches(self, word, prefix):
+        """
+        Returns the postings of every indexed word a query word
+        matches: just itself, or every word it is a prefix of.
+        """
+        if not prefix or len(word) < MIN_PREFIX_LENGTH:
+            postings = self._postings.get(word)
+            return [postings] if postings else []
+        matches = []
+        start = bisect.bisect_left(self._words, word)
+        for indexed in self._words[start:start + MAX_PREFIX_EXPANSION]:
+            if not indexed.startswith(word):
+                break
+            matches.append(self._postings[indexed])
+        return matches
+
+    def search(self, text, resource_type=None, filter_fields=(), verified=True,
+               limit=20, offset=0):
+        """
+        Returns (records, total): one page of the resources matching
+        every word of text, best match first, and the number of
+        resources matching in all. Only resources of resource_type
+        (if given), with every field in filter_fields set, and with
+        the given verified state are returned.
+        """
+        words = tokenize(text)
+        if not words:
+            return [], 0
+        with self._lock:
+            # The resources passing the filters.
+            allowed = [self._verified if verified else self._unverified]
+            if resource_type:
+                allowed.append(self._by_type.get(resource_type, set()))
+            for field in filter_fields:
+                allowed.append(self._by_flag.get(field, set()))
+            # Each query word, with the weight of its best match in each
+            # resource and how rare it is (the rarer, the more it counts).
+            document_count = len(self._entries)
+            terms = []
+            for position, word in enumerate(words):
+                matches = self._matches(word, prefix=(position == len(words) - 1))
+                if not matches:
+                    return [], 0
+                if len(matches) == 1:
+                    weights = matches[0]
+                else:
+                    weights = {}
+                    for postings in matches:
+                        for record_id, weight in postings.items():
+                            if weight > weights.get(record_id, 0.0):
+                                weights[record_id] = weight
+                terms.append((weights, math.log(1.0 + document_count / len(weights))))
+            # Intersect smallest first, so the candidate set shrinks fastest.
+            candidate_sets = [weights.keys() for weights, _ in terms] + allowed
+            candidate_sets.sort(key=len)
+            candidates = set(candidate_sets[0])
+            for ids in candidate_sets[1:]:
+                candidates &= ids
+                if not candidates:
+                    return [], 0
+
+            scores = dict.fromkeys(candidates, 0.0)
+            for weights, rarity in terms:
+                for record_id in candidates:
+                    scores[record_id] += weights[record_id] * rarity
+
+            # Scores take few distinct values, so rank by score in groups
+            # and sort by name only within the groups the page reaches.
+            by_score = {}
+            for record_id, score in scores.items():
+                by_score.setdefault(score, []).append(record_id)
+            entries = self._entries
+            ranked = []
+            for score in sorted(by_score, reverse=True):
+                group = by_score[score]
+                group.sort(key=lambda record_id: entries[record_id].name)
+                ranked.extend(group)
+                if len(ranked) >= offset + limit:
+                    break
+            best = ranked[:offset + limit]
+            return [entries[record_id].record for record_id in best[offset:]], len(candidates)
@@ -0,0 +1,306 @@
+"""
+A snapshot of the verified catalogue in one memory-mapped file.
+Every server process maps the same file, so the catalogue is held
+once, in the page cache, however many workers there are, and
+/_disp is answered without asking mongo or building anything.
+
+The file holds, after an 8 byte magic and a 4 byte header length,
+a JSON header and then the data it points into:
+  - for each type, the whole /_disp response body, identity and
+    gzip (and brotli, if installed) encoded, with its ETag;
+  - for each type, a record index: the (offset, length, filter
+    flags) of each record's JSON inside that body, so filtered
+    /_disp bodies are put together from slices of the file;
+  - the /_verifiedcategories response body.
+A new snapshot is written beside the old one and renamed over it,
+so readers only ever see a whole file.
+"""
+
+import fcntl
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import catalogue  # Resource queries and indexes
+import responses  # Cacheable, compressible JSON bodies
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"TPSNAP1\n"
+HEADER_LENGTH = struct.Struct("<I")
+# Per record: offset and length of its JSON within the body, and its flags.
+RECORD = struct.Struct("<III")
+
+# Flag bit for each /_disp filter field.
+FILTER_BITS = {field: 1 << i for i, field in enumerate(catalogue.DISP_FILTERS.values())}
+
+DISP_PREFIX = b'{"result":{"resources":['
+DISP_SUFFIX = b"]}}"
+
+
+def record_flags(record):
+    flags = 0
+    for field, bit in FILTER_BITS.items():
+        if record.get(field) is True:
+            flags |= bit
+    return flags
+
+
+class _Writer:
+    """
+    Appends blocks to the data section of a snapshot being built.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+
+    def add(self, data):
+        start = self.offset
+        self.out.write(data)
+        self.offset += len(data)
+        return [start, len(data)]
+
+    def add_body(self, data):
+        """
+        Adds a response body and its compressed forms.
+        """
+        body = {"identity": self.add(data), "gzip": self.add(gzip.compress(data, mtime=0)),
+                "etag": hashlib.sha1(data).hexdigest()}
+        if responses.brotli is not None:
+            body["br"] = self.add(responses.brotli.compress(data))
+        return body
+
+
+def write(path, records):
+    """
+    Writes a snapshot of records (verified resources, without their
+    _id, sorted by type and then as /_disp sorts them) to path,
+    replacing any snapshot there in one step. Returns the number of
+    records written.
+    """
+    header = {"built": time.time(), "types": {}, "filters": list(FILTER_BITS)}
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    data_path = temp + ".data"
+    count = 0
+    with open(data_path, "w+b") as data:
+        writer = _Writer(data)
+        current = None
+        parts = []
+        index = []
+        position = 0  # Of the next record, within the joined records
+
+        def finish_type():
+            body = DISP_PREFIX + b",".join(parts) + DISP_SUFFIX
+            entry = writer.add_body(body)
+            # Offsets of the records within the identity body.
+            base = entry["identity"][0] + len(DISP_PREFIX)
+            entry["index"] = writer.add(b"".join(
+                RECORD.pack(base + start, length, flags) for start, length, flags in index))
+            entry["count"] = len(index)
+            header["types"][current] = entry
+
+        for record in records:
+            if record.get("type") != current:
+                if current is not None:
+                    finish_type()
+                current = record.get("type")
+                parts = []
+                index = []
+                position = 0
+            encoded = responses.dumps(record)
+            parts.append(encoded)
+            index.append((position, len(encoded), record_flags(record)))
+            position += len(encoded) + 1  # And the comma
+            count += 1
+        if current is not None:
+            finish_type()
+        header["categories"] = writer.add_body(
+            responses.dumps({"result": {"types": sorted(header["types"])}}))
+
+        encoded_header = json.dumps(header).encode("utf-8")
+        with open(temp, "wb") as out:
+            out.write(MAGIC + HEADER_LENGTH.pack(len(encoded_header)) + encoded_header)
+            data.seek(0)
+            while True:
+                chunk = data.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+    os.remove(data_path)
+    os.replace(temp, path)
+    return count
+
+
+class SnapshotBody:
+    """
+    A response body held in a snapshot, usable with responses.send
+    in place of a JSONBody. Its bytes are sliced from the mapping
+    only when the response is made.
+    """
+    def __init__(self, mapping, base, entry):
+        self._mapping = mapping
+        self._base = base
+        self._entry = entry
+        self.etag = entry["etag"]
+        self.size = entry["identity"][1]
+
+    def _slice(self, span):
+        start = self._base + span[0]
+        return self._mapping[start:start + span[1]]
+
+    @property
+    def data(self):
+        return self._slice(self._entry["identity"])
+
+    def encoded(self, encoding, level=6):
+        if encoding in self._entry:
+            return self._slice(self._entry[encoding])
+        return responses.JSONBody(self.data).encoded(encoding, level)
+
+
+class Snapshot:
+    """
+    One mapped snapshot file.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self._mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mapping[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a catalogue snapshot".format(path))
+        start = len(MAGIC) + HEADER_LENGTH.size
+        (length,) = HEADER_LENGTH.unpack(self._mapping[len(MAGIC):start])
+        self.header = json.loads(self._mapping[start:start + length].decode("utf-8"))
+        # Flag bits are only meaningful for the filters they were built for.
+        if self.header.get("filters") != list(FILTER_BITS):
+            raise ValueError("{} was built for other /_disp filters".format(path))
+        self._base = start + length
+        self._filtered = {}  # (type, filter fields) -> JSONBody
+        self._lock = threading.Lock()
+
+    def categories_body(self):
+        return SnapshotBody(self._mapping, self._base, self.header["categories"])
+
+    def disp_body(self, resource_type, filter_fields=()):
+        """
+        Returns the /_disp body for the verified resources of a type,
+        restricted to those with every field in filter_fields set.
+        """
+        entry = self.header["types"].get(resource_type)
+        if entry is None:
+            return responses.JSONBody.of(result={"resources": []})
+        if not filter_fields:
+            return SnapshotBody(self._mapping, self._base, entry)
+        key = (resource_type, tuple(filter_fields))
+        with self._lock:
+            body = self._filtered.get(key)
+        if body is None:
+            body = responses.JSONBody(DISP_PREFIX + b",".join(
+                self._records(entry, filter_fields)) + DISP_SUFFIX)
+            with self._lock:
+                self._filtered[key] = body
+        return body
+
+    def _records(self, entry, filter_fields):
+        mask = 0
+        for field in filter_fields:
+            mask |= FILTER_BITS[field]
+        index_start = self._base + entry["index"][0]
+        index = self._mapping[index_start:index_start + entry["index"][1]]
+        for offset, length, flags in RECORD.iter_unpack(index):
+            if flags & mask == mask:
+                start = self._base + offset
+                yield self._mapping[start:start + length]
+
+
+class SnapshotFile:
+    """
+    The snapshot at path, as seen by one server process: remapped
+    when another process replaces it, and rebuilt in the background
+    (by at most one process at a time) when this process asks.
+    """
+    def __init__(self, path, min_interval=5, check_interval=1):
+        self.path = path
+        self.min_interval = min_interval  # Seconds between rebuilds
+        self.check_interval = check_interval  # Seconds between checks for a new file
+        self._snapshot = None
+        self._stat = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._pending = False
+        self._builder = None
+        self.builds = 0
+
+    def current(self):
+        """
+        Returns the latest Snapshot, or None if there is none yet.
+        """
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                self._snapshot = None
+                self._stat = None
+                return None
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if key != self._stat:
+                try:
+                    self._snapshot = Snapshot(self.path)
+                    self._stat = key
+                except (OSError, ValueError) as err:
+                    log.warning("Could not map catalogue snapshot: {}".format(err))
+            return self._snapshot
+
+    def build(self, load_records):
+        """
+        Writes a new snapshot from load_records(), holding a lock file
+        so that processes rebuilding at once take turns, and each
+        reads the catalogue after the last one wrote.
+        """
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                count = write(self.path, load_records())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.builds += 1
+        self._checked = 0  # Map the new file on the next request
+        return count
+
+    def rebuild_later(self, load_records):
+        """
+        Rebuilds the snapshot in a background thread. Requests made
+        while a rebuild is waiting or running are folded into one
+        more rebuild once it is done.
+        """
+        with self._lock:
+            self._pending = True
+            if self._builder is not None and self._builder.is_alive():
+                return
+            self._builder = threading.Thread(target=self._rebuild, args=(load_records,),
+                                             daemon=True)
+            self._builder.start()
+
+    def _rebuild(self, load_records):
+        while True:
+            time.sleep(self.min_interval)
+            with self._lock:
+                if not self._pending:
+                    self._builder = None
+                    return
+                self._pending = False
+            try:
+                self.build(load_records)
+            except Exception as err:
+                log.warning("Catalogue snapshot rebuild failed: {}".format(err))
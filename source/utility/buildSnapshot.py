@@ -0,0 +1,41 @@
+"""
+Builds the catalogue snapshot at snapshot_path from the database,
+e.g. after loading data with loadDB.py. Running servers map the
+new snapshot within a second of it being written.
+"""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pymongo import MongoClient  # Mongo database
+import config  # Get config settings from credentials file
+import catalogue  # Resource queries and indexes
+import snapshot  # Verified catalogue in a file shared by all workers
+
+CONFIG = config.configuration()
+
+if not getattr(CONFIG, "SNAPSHOT_PATH", None):
+    print("No snapshot_path is configured")
+    sys.exit(1)
+
+MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+    CONFIG.DB_USER,
+    CONFIG.DB_USER_PW,
+    CONFIG.DB_HOST,
+    CONFIG.DB_PORT,
+    CONFIG.DB)
+
+try:
+    dbclient = MongoClient(MONGO_CLIENT_URL)
+    db = getattr(dbclient, str(CONFIG.DB))
+    collection = db.resources
+    catalogue.ensure_indexes(collection)
+except:
+    print("Failure opening database. Is Mongo running? Correct password?")
+    sys.exit(1)
+
+snapshot_file = snapshot.SnapshotFile(CONFIG.SNAPSHOT_PATH)
+count = snapshot_file.build(lambda: catalogue.find_verified(collection))
+print("Wrote {} verified resources to {}".format(count, CONFIG.SNAPSHOT_PATH))
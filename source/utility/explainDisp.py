@@ -0,0 +1,50 @@
+"""
+Checks that every /_disp query is answered from an index.
+Explains the query for each verified category and each
+combination of filters, and exits with status 1 if any of them
+needs a collection scan or an in-memory sort.
+"""
+
+import itertools
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pymongo import MongoClient  # Mongo database
+import config  # Get config settings from credentials file
+import catalogue  # Resource queries and indexes
+
+CONFIG = config.configuration()
+
+MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+    CONFIG.DB_USER,
+    CONFIG.DB_USER_PW,
+    CONFIG.DB_HOST,
+    CONFIG.DB_PORT,
+    CONFIG.DB)
+
+try:
+    dbclient = MongoClient(MONGO_CLIENT_URL)
+    db = getattr(dbclient, str(CONFIG.DB))
+    collection = db.resources
+    catalogue.ensure_indexes(collection)
+except:
+    print("Failure opening database. Is Mongo running? Correct password?")
+    sys.exit(1)
+
+filter_fields = list(catalogue.DISP_FILTERS.values())
+failures = 0
+for resource_type in collection.distinct("type", {"verified": True}):
+    for count in range(len(filter_fields) + 1):
+        for fields in itertools.combinations(filter_fields, count):
+            ok, index_name, stages = catalogue.explain_disp(collection, resource_type, fields)
+            print("{} {!r} {}: {} via {}".format(
+                "ok  " if ok else "FAIL", resource_type, list(fields),
+                " <- ".join(stages), index_name))
+            if not ok:
+                failures += 1
+
+if failures:
+    print("{} /_disp queries are not index backed".format(failures))
+    sys.exit(1)
@@ -0,0 +1,117 @@
+"""
+Exports the verified catalogue, as /_export does, to a file or
+stdout: newline delimited JSON (the default) or CSV, which
+loadDB.py can load. Rows are written as they are read from the
+database, so memory stays the same however big the catalogue is.
+With --resume, an export to a file that was cut short carries on
+after the last resource written.
+
+    python3 exportCatalogue.py --out catalogue.ndjson
+    python3 exportCatalogue.py --format csv --gzip --out catalogue.csv.gz --resume
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pymongo import MongoClient  # Mongo database
+import config  # Get config settings from credentials file
+import catalogue  # Resource queries and indexes
+import export  # The catalogue as a stream of rows
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(description="Export the verified catalogue")
+    parser.add_argument("--format", choices=sorted(export.FORMATS), default="ndjson",
+                        help="Output format (default ndjson)")
+    parser.add_argument("--out", default="-", help="File to write; default stdout")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output")
+    parser.add_argument("--type", help="Export only this category")
+    parser.add_argument("--after", help="Export only the resources after this id")
+    parser.add_argument("--resume", action="store_true",
+                        help="Append to --out, after the last resource it holds")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="Resources read from the database at a time (default 500)")
+    return parser.parse_args()
+
+
+def open_output(args, append):
+    if args.out == "-":
+        return sys.stdout.buffer
+    if args.gzip:
+        # Appending adds a gzip member, which readers join up.
+        return gzip.open(args.out, "ab" if append else "wb")
+    return open(args.out, "ab" if append else "wb")
+
+
+def last_id(args):
+    """
+    Returns the id of the last resource in the --out file, or None
+    if it holds none.
+    """
+    if args.out == "-" or not os.path.exists(args.out):
+        return None
+    last = None
+    with (gzip.open if args.gzip else open)(args.out, "rt", encoding="utf-8", newline="") as lines:
+        if args.format == "csv":
+            # Notes may span lines; only the csv reader knows where rows end.
+            for row in csv.reader(lines):
+                if row and row != export.CSV_COLUMNS:
+                    last = row[-1]
+        else:
+            for line in lines:
+                if line.strip():
+                    last = json.loads(line)["id"]
+    return last
+
+
+if __name__ == "__main__":
+    args = command_line_args()
+    # The command line belongs to the exporter, so configure from the ini files only.
+    CONFIG = config.configuration(proxied=True)
+
+    MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+        CONFIG.DB_USER,
+        CONFIG.DB_USER_PW,
+        CONFIG.DB_HOST,
+        CONFIG.DB_PORT,
+        CONFIG.DB)
+
+    try:
+        dbclient = MongoClient(MONGO_CLIENT_URL)
+        db = getattr(dbclient, str(CONFIG.DB))
+        collection = db.resources
+        catalogue.ensure_indexes(collection)  # read_resources hints type_verified_id
+    except:
+        print("Failure opening database. Is Mongo running? Correct password?")
+        sys.exit(1)
+
+    after = args.after
+    resumed = args.resume and last_id(args)
+    if resumed:
+        after = resumed
+    documents = export.read_resources(collection, args.type, export.parse_after(after), args.batch_size)
+    written = 0
+
+    def counted(documents):
+        global written
+        for document in documents:
+            written += 1
+            yield document
+
+    rows = export.rows(counted(documents), args.format)
+    if resumed and args.format == "csv":
+        next(rows)  # The file already has the header
+    output = open_output(args, append=bool(resumed))
+    for chunk in export.chunked(rows):
+        output.write(chunk)
+    output.flush()
+    if output is not sys.stdout.buffer:
+        output.close()
+    print("Exported {} resources{}".format(written, " after " + after if after else ""),
+          file=sys.stderr)
@@ -0,0 +1,66 @@
+"""
+Brings a database loaded before duplicate detection up to date:
+gives every resource its name_key and dup_keys, then flags the
+unverified resources that look like duplicates, so they show up
+in the moderation queue ready to merge. Resources with the same
+type and name as one already keyed keep no name_key, and are
+listed here; merge or delete them, then run this again.
+
+    python3 findDuplicates.py
+"""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pymongo import MongoClient  # Mongo database
+from pymongo.errors import DuplicateKeyError
+import config  # Get config settings from credentials file
+import catalogue  # Resource queries and indexes
+import dedupe  # Near-duplicate detection
+
+CONFIG = config.configuration()
+
+MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+    CONFIG.DB_USER,
+    CONFIG.DB_USER_PW,
+    CONFIG.DB_HOST,
+    CONFIG.DB_PORT,
+    CONFIG.DB)
+
+try:
+    dbclient = MongoClient(MONGO_CLIENT_URL)
+    db = getattr(dbclient, str(CONFIG.DB))
+    collection = db.resources
+    catalogue.ensure_indexes(collection)
+except:
+    print("Failure opening database. Is Mongo running? Correct password?")
+    sys.exit(1)
+
+keyed = clashes = 0
+for record in collection.find({"$or": [{"name_key": {"$exists": False}},
+                                       {"dup_keys": {"$exists": False}}]}):
+    keys = {"dup_keys": dedupe.dup_keys(record)}
+    name_key = catalogue.name_key(record.get("type"), record.get("name"))
+    try:
+        collection.update_one({"_id": record["_id"]},
+                              {"$set": dict(keys, name_key=name_key), "$inc": {"version": 1}})
+    except DuplicateKeyError:
+        collection.update_one({"_id": record["_id"]}, {"$set": keys, "$inc": {"version": 1}})
+        print("Same type and name as another resource: {} ({})".format(record.get("name"),
+                                                                      record["_id"]))
+        clashes += 1
+    keyed += 1
+
+flagged = 0
+for record in collection.find({"verified": False}):
+    duplicates = dedupe.find_duplicates(collection, record)
+    if duplicates != record.get("duplicates", []):
+        collection.update_one({"_id": record["_id"]},
+                              {"$set": {"duplicates": duplicates}, "$inc": {"version": 1}})
+    if duplicates:
+        flagged += 1
+
+print("Keyed {} resources ({} clashing names); {} unverified resources look like duplicates".format(
+    keyed, clashes, flagged))
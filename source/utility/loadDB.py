@@ -1,111 +1,242 @@
+"""
+Bulk loader: pushes a spreadsheet of resources into the database.
 
+Reads tab separated (the default, as pasted from a spreadsheet),
+comma separated, or .xlsx rows lazily, one row at a time, with the
+columns in the order of catalogue.COLUMNS (optionally followed by a
+latitude and longitude) and one header row.
+Rows are normalized by the same rules as the web app's /_create,
+and written in unordered batches of upserts keyed on the normalized
+type and name (catalogue.name_key), so loading the same file twice
+does not duplicate anything. Run findDuplicates.py (make duplicates)
+first on a database loaded before name_key existed.
+
+After each batch is written, the number of rows consumed is saved
+to a checkpoint file; if a load fails part way, run it again with
+--resume to carry on after the last batch written.
+
+    python3 loadDB.py < data.txt
+    python3 loadDB.py providers.xlsx --batch-size 2000 --resume
+"""
+
+import argparse
+import csv
+import io
 import logging
-import flask  # Web server tool.
-import arrow  # For times and times.
-from pymongo import MongoClient  # Mongo database
-import re
-import os,sys,inspect
+import os, sys, inspect
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
-sys.path.insert(0,parentdir) 
+sys.path.insert(0, parentdir)
 
+from pymongo import MongoClient, UpdateOne  # Mongo database
+from pymongo.errors import BulkWriteError
 import config  # Get config settings from credentials file
+import catalogue  # Resource fields and normalization
+import facets  # Counts of resources by type and attribute
+import changes  # Catalogue revisions for /_changes
+import dedupe  # Near-duplicate detection
+
+log = logging.getLogger("loadDB")
+
+
+def command_line_args():
+    parser = argparse.ArgumentParser(description="Bulk load resources into the database")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="File to load (.tsv, .csv, .txt or .xlsx); default stdin")
+    parser.add_argument("--format", choices=["tsv", "csv", "xlsx"],
+                        help="Input format, if not implied by the file name (default tsv)")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="Resources per bulk write (default 1000)")
+    parser.add_argument("--header-rows", type=int, default=1,
+                        help="Rows to skip at the top of the input (default 1)")
+    parser.add_argument("--checkpoint",
+                        help="Checkpoint file (default <input>.checkpoint)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skip the rows a previous run already loaded")
+    parser.add_argument("--unverified", action="store_true",
+                        help="Load resources as unverified submissions")
+    return parser.parse_args()
+
+
+def input_format(args):
+    if args.format:
+        return args.format
+    extension = os.path.splitext(args.input)[1].lower()
+    if extension in (".xlsx", ".csv"):
+        return extension[1:]
+    return "tsv"
 
-####
-# App globals.
-###
-CONFIG = config.configuration()
-
-MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
-    CONFIG.DB_USER,
-    CONFIG.DB_USER_PW,
-    CONFIG.DB_HOST,
-    CONFIG.DB_PORT,
-    CONFIG.DB)
-
-if CONFIG.DEBUG is True:
-    print("Using URL '{}'".format(MONGO_CLIENT_URL))
-
-####
-# Database connection per server process
-###
-try:
-    dbclient = MongoClient(MONGO_CLIENT_URL)
-    db = getattr(dbclient, str(CONFIG.DB))
-    collection = db.resources
-    users_collection = db.users
-except:
-    print("Failure opening database. Is Mongo running? Correct password?")
-    sys.exit(1)
-
-# Care Provider Category
-# Provider Name
-# Office/Clinic Name (if applicable)
-# Address
-# Phone
-# Email
-# Web address
-# Do they take Oregon Health Plan (OHP)?
-# Do they take private insurance?
-# Sliding Scale Option?
-# Has staff received Gender Diversity Awareness Training?
-# Does intake or chart paperwork include more options than M or F?
-# Does paperwork ask for pronoun?
-# Can Monitor Hormones?
-# Notes
-def create(line):
-    print(len(info))
-    print(info)
-    
-    checklist = [7,8,11,12,13]
-    for i in checklist:
-    	if info[i] == "Yes" or info[i] == "yes" or info[i] == "HRT":
-    	    info[i] = True
-    	if info[i] == "No" or info[i] == "no":
-    	    info[i] = False
-    
-    new = {"type": info[0],
-           "name": info[1],
-           "office_name": info[2],
-           "address": info[3],
-           "phone": info[4],
-           "email": info[5],
-           "website": info[6],
-           "takes_OHP": info[7],
-           "takes_private_ins": info[8],
-           "sliding_scale": info[9],
-           "diversity_aware": info[10],
-           "paperwork_not_only_mf": info[11],
-           "paperwork_asks_for_pronoun": info[12],
-           "can_monitor_hormones": info[13],
-           "notes": info[14],
-           "verified": True
-           }
-    res = collection.insert(new)
-    if hasattr(res, "writeConcernError"):
-        app.logger.debug(res["writeConcernError"])
-        return False
-    elif hasattr(res, "writeError"):
-        app.logger.debug(res["writeError"])
-        return False
+
+def read_rows(args):
+    """
+    Yields each row of the input as a list of cell strings.
+    """
+    fmt = input_format(args)
+    if fmt == "xlsx":
+        import openpyxl  # Only needed for spreadsheets
+        workbook = openpyxl.load_workbook(args.input, read_only=True, data_only=True)
+        for row in workbook.active.iter_rows(values_only=True):
+            yield ["" if cell is None else str(cell) for cell in row]
+        workbook.close()
+        return
+    delimiter = "," if fmt == "csv" else "\t"
+    if args.input == "-":
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
     else:
-        return True
-
-input = sys.stdin.read().split("\n")
-total = len(input)
-i = 1
-while i < total:
-    for char in input[i]:
-        if char == '\t' or char == '' or char == '\r':
+        stream = open(args.input, encoding="utf-8", newline="")
+    with stream:
+        for row in csv.reader(stream, delimiter=delimiter):
+            yield row
+
+
+def join_split_rows(rows):
+    """
+    Yields (rows consumed, cells) for each resource. Text pasted
+    from a spreadsheet without quoting breaks a cell holding line
+    breaks across several rows; those are joined back together.
+    Blank rows are skipped.
+    """
+    rows = iter(rows)
+    needed = len(catalogue.COLUMNS) - 1  # The notes may be empty
+    for row in rows:
+        consumed = 1
+        if not any(cell.strip() for cell in row):
+            yield consumed, None
+            continue
+        cells = list(row)
+        while len(cells) < needed:
+            more = next(rows, None)
+            if more is None:
+                break
+            consumed += 1
+            if more:
+                cells[-1] += "\n" + more[0]
+                cells.extend(more[1:])
+        yield consumed, cells
+
+
+# How the spreadsheets say yes, besides the form's "yes"; the
+# hormone monitoring column also says "HRT".
+SPREADSHEET_YES = ("Yes", "yes")
+HORMONES_YES = SPREADSHEET_YES + ("HRT",)
+
+
+def form_answers(fields):
+    """
+    Rewrites the yes/no cells of a row as the submission form
+    answers them, for catalogue.interp_bool.
+    """
+    for field in catalogue.BOOLEAN_FIELDS:
+        answer = (fields.get(field) or "").strip()
+        yes = HORMONES_YES if field == "can_monitor_hormones" else SPREADSHEET_YES
+        fields[field] = "yes" if answer in yes else answer
+
+
+def to_resource(cells, verified):
+    fields = dict(zip(catalogue.COLUMNS + catalogue.OPTIONAL_COLUMNS, cells))
+    form_answers(fields)
+    resource = catalogue.new_resource(fields, verified=verified)
+    resource["dup_keys"] = dedupe.dup_keys(resource)
+    return resource
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, rows_done):
+    # Written to the side and renamed, so a crash never leaves a torn file.
+    with open(path + ".tmp", "w") as checkpoint:
+        checkpoint.write(str(rows_done))
+    os.replace(path + ".tmp", path)
+
+
+def write_batch(collection, batch):
+    """
+    Upserts a batch of resources in one unordered bulk write.
+    Returns the pymongo BulkWriteResult.
+    """
+    # Every write bumps the version, so cached encodings of the
+    # resource are not reused, and stamps a new revision for /_changes.
+    # Only new resources take the load's verified flag; reloading a
+    # resource leaves its moderation alone.
+    first_rev = changes.next_revs(collection.database.counters, len(batch))
+    ops = [UpdateOne({"name_key": resource["name_key"]},
+                     {"$set": dict({field: value for field, value in resource.items()
+                                    if field not in ("version", "verified")}, rev=first_rev + offset),
+                      "$setOnInsert": {"verified": resource["verified"]},
+                      "$inc": {"version": 1}}, upsert=True)
+           for offset, resource in enumerate(batch)]
+    return collection.bulk_write(ops, ordered=False)
+
+
+def load(collection, args):
+    checkpoint = args.checkpoint or (
+        "loadDB.checkpoint" if args.input == "-" else args.input + ".checkpoint")
+    skip = read_checkpoint(checkpoint) if args.resume else 0
+    if skip:
+        log.info("Resuming after row {}".format(skip))
+    verified = not args.unverified
+
+    rows_done = 0  # Input rows consumed, including the header
+    batch = []
+    upserted = modified = 0
+    rows = read_rows(args)
+    for _ in range(args.header_rows):
+        if next(rows, None) is not None:
+            rows_done += 1
+    for consumed, cells in join_split_rows(rows):
+        rows_done += consumed
+        if rows_done <= skip or cells is None:
             continue
-        print(input[i])
-        info = re.split(r'\t+', input[i].rstrip('\t'))
-        while len(info) < 14:
-            i+=1
-            more = re.split(r'\t+', input[i].rstrip('\t'))
-            info[-1] += more[0]
-            more.remove(more[0])
-            info.extend(more)
-        create(info)
-        break
-    i+=1
+        batch.append(to_resource(cells, verified))
+        if len(batch) >= args.batch_size:
+            result = write_batch(collection, batch)
+            upserted += result.upserted_count
+            modified += result.modified_count
+            write_checkpoint(checkpoint, rows_done)
+            log.info("Loaded through row {}".format(rows_done))
+            batch = []
+    if batch:
+        result = write_batch(collection, batch)
+        upserted += result.upserted_count
+        modified += result.modified_count
+    # Finished: a later run starts from the top again.
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    log.info("Done: {} rows, {} new resources, {} updated".format(rows_done, upserted, modified))
+
+
+if __name__ == "__main__":
+    args = command_line_args()
+    # The command line belongs to the loader, so configure from the ini files only.
+    CONFIG = config.configuration(proxied=True)
+
+    MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+        CONFIG.DB_USER,
+        CONFIG.DB_USER_PW,
+        CONFIG.DB_HOST,
+        CONFIG.DB_PORT,
+        CONFIG.DB)
+
+    try:
+        dbclient = MongoClient(MONGO_CLIENT_URL)
+        db = getattr(dbclient, str(CONFIG.DB))
+        collection = db.resources
+        catalogue.ensure_indexes(collection)
+    except:
+        print("Failure opening database. Is Mongo running? Correct password?")
+        sys.exit(1)
+
+    try:
+        load(collection, args)
+    except BulkWriteError as err:
+        log.error("Batch failed: {}".format(err.details.get("writeErrors", [])[:5]))
+        log.error("Run again with --resume to continue from the last checkpoint")
+        sys.exit(1)
+    # The running app's counts did not see these writes.
+    facets.reconcile(collection, db.facet_counts)
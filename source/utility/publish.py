@@ -0,0 +1,42 @@
+"""
+Publishes the whole verified catalogue to publish_dir as static
+JSON files (see publisher.py), e.g. after loading data with
+loadDB.py. Running servers republish the categories they change.
+"""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from pymongo import MongoClient  # Mongo database
+import config  # Get config settings from credentials file
+import catalogue  # Resource queries and indexes
+import publisher  # Verified catalogue as static files for a CDN
+
+CONFIG = config.configuration()
+
+if not getattr(CONFIG, "PUBLISH_DIR", None):
+    print("No publish_dir is configured")
+    sys.exit(1)
+
+MONGO_CLIENT_URL = "mongodb://{}:{}@{}:{}/{}".format(
+    CONFIG.DB_USER,
+    CONFIG.DB_USER_PW,
+    CONFIG.DB_HOST,
+    CONFIG.DB_PORT,
+    CONFIG.DB)
+
+try:
+    dbclient = MongoClient(MONGO_CLIENT_URL)
+    db = getattr(dbclient, str(CONFIG.DB))
+    collection = db.resources
+    catalogue.ensure_indexes(collection)
+except:
+    print("Failure opening database. Is Mongo running? Correct password?")
+    sys.exit(1)
+
+categories = collection.distinct("type", {"verified": True})
+catalogue_publisher = publisher.Publisher(CONFIG.PUBLISH_DIR)
+catalogue_publisher.publish(categories, lambda resource_type: catalogue.find_disp(collection, resource_type))
+print("Published {} categories to {}".format(len(categories), CONFIG.PUBLISH_DIR))
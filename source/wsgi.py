@@ -0,0 +1,10 @@
+"""
+The app, for WSGI servers:
+   cd source; gunicorn -c gunicorn.conf.py wsgi:app
+Configured from app.ini and credentials.ini; the command line
+belongs to the server.
+"""
+
+import flask_main
+
+app = flask_main.create_app()